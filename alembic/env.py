@@ -0,0 +1,38 @@
+import asyncio
+
+from alembic import context
+from sqlalchemy import Connection
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from config import settings
+# Пакет database при импорте подтягивает все модели, так что метаданные полные
+from database.base import Base
+
+config = context.config
+target_metadata = Base.metadata
+
+
+def run_migrations(connection: Connection):
+    # render_as_batch: SQLite не умеет большинство ALTER TABLE, alembic пересоздаёт таблицу целиком
+    context.configure(connection=connection, target_metadata=target_metadata, render_as_batch=True)
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+async def run_async_migrations():
+    engine = create_async_engine(settings.database.url)
+    async with engine.connect() as connection:
+        await connection.run_sync(run_migrations)
+        await connection.commit()
+    await engine.dispose()
+
+
+if context.is_offline_mode():
+    context.configure(url=settings.database.url, target_metadata=target_metadata, literal_binds=True)
+    with context.begin_transaction():
+        context.run_migrations()
+elif config.attributes.get("connection") is not None:
+    # Миграции из database.check_tables: соединение и транзакцию даёт клиент
+    run_migrations(config.attributes["connection"])
+else:
+    asyncio.run(run_async_migrations())
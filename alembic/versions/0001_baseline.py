@@ -0,0 +1,34 @@
+"""Схема первых версий клиента: только таблица numbers с фотографиями в BLOB
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 21:00:00
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "numbers",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("server_id", sa.Integer(), nullable=True),
+        sa.Column("number", sa.String(), nullable=False),
+        sa.Column(
+            "status",
+            sa.Enum("CREATED", "COMPLETED", "SECONDCHECK", "ERROR", name="numberstatus"),
+            nullable=False,
+        ),
+        sa.Column("image", sa.LargeBinary(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("number"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("numbers")
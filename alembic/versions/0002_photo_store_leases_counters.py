@@ -0,0 +1,84 @@
+"""Фотографии в PhotoStore, аренда номеров, счётчики статусов и индекс выгруженных фотографий
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 21:00:00
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+
+def numbers_columns() -> list[sa.Column]:
+    # Каждый раз новые объекты: op.add_column привязывает колонку к таблице
+    return [
+        sa.Column("image_hash", sa.String(64), nullable=True),
+        sa.Column("lease_expires_at", sa.DateTime(), nullable=True),
+        sa.Column("attempts", sa.Integer(), server_default="0", nullable=False),
+    ]
+
+
+NUMBERS_INDEXES = {
+    "ix_numbers_image_hash": ["image_hash"],
+    "ix_numbers_status_server_id": ["status", "server_id", "lease_expires_at"],
+}
+
+
+def upgrade() -> None:
+    # Базы, созданные до появления alembic, могли уже получить часть колонок и таблиц через create_all,
+    # поэтому создаём только то, чего нет (при генерации SQL без базы - всё)
+    existing_columns, existing_indexes, existing_tables = set(), set(), set()
+    if not op.get_context().as_sql:
+        inspector = sa.inspect(op.get_bind())
+        existing_columns = {column["name"] for column in inspector.get_columns("numbers")}
+        existing_indexes = {index["name"] for index in inspector.get_indexes("numbers")}
+        existing_tables = set(inspector.get_table_names())
+
+    for column in numbers_columns():
+        if column.name not in existing_columns:
+            op.add_column("numbers", column)
+    # Номера в SECONDCHECK уже упали один раз: без этого после миграции они получили бы лишнюю попытку
+    op.execute("UPDATE numbers SET attempts = 1 WHERE status = 'SECONDCHECK' AND attempts = 0")
+    for name, columns in NUMBERS_INDEXES.items():
+        if name not in existing_indexes:
+            op.create_index(name, "numbers", columns)
+
+    if "status_counters" not in existing_tables:
+        op.create_table(
+            "status_counters",
+            sa.Column("mode", sa.String(7), nullable=False),
+            sa.Column("status", sa.String(11), nullable=False),
+            sa.Column("count", sa.Integer(), server_default="0", nullable=False),
+            sa.PrimaryKeyConstraint("mode", "status"),
+        )
+    if "throughput_buckets" not in existing_tables:
+        op.create_table(
+            "throughput_buckets",
+            sa.Column("minute", sa.Integer(), nullable=False),
+            sa.Column("mode", sa.String(7), nullable=False),
+            sa.Column("handled", sa.Integer(), server_default="0", nullable=False),
+            sa.PrimaryKeyConstraint("minute", "mode"),
+        )
+    if "uploaded_photos" not in existing_tables:
+        op.create_table(
+            "uploaded_photos",
+            sa.Column("image_hash", sa.String(64), nullable=False),
+            sa.Column("uploaded_at", sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint("image_hash"),
+        )
+
+
+def downgrade() -> None:
+    op.drop_table("uploaded_photos")
+    op.drop_table("throughput_buckets")
+    op.drop_table("status_counters")
+    for name in NUMBERS_INDEXES:
+        op.drop_index(name, "numbers")
+    with op.batch_alter_table("numbers") as batch:
+        for column in reversed(numbers_columns()):
+            batch.drop_column(column.name)
@@ -17,6 +17,7 @@ from handlers.data_handler import DataHandler
 from handlers.heartbeat_handler import HeartbeatHandler
 from parser.parser import Parser
 from services.base_sender_service import BaseSenderService
+from services.metrics_service import MetricsService
 from services.nats_sender_service import NatsSenderService
 from services.zmq_listener_service import ZmqListenerService
 
@@ -28,6 +29,9 @@ def apply_sync(o):
 class InitMessage(BaseModel):
     id: Optional[int]
     username: str
+    # Клиент перечисляет кодеки, которые умеет, сервер в ответе - те, что готов принимать.
+    # Старый сервер поле не знает и не присылает, тогда остаёмся на голом LZMA
+    codecs: Optional[list[str]]
 
 
 class AppContainer:
@@ -36,6 +40,8 @@ class AppContainer:
     parser: Parser | None = None
     nc: Client | None = None
     zmq_listener: ZmqListenerService | None = None
+    metrics_service: MetricsService | None = None
+    metrics_task: asyncio.Task | None = None
     handlers: list[BaseHandler] = []
     logger: logging.Logger = logging.getLogger("__main__")
 
@@ -58,15 +64,21 @@ class AppContainer:
 
     async def authenticate(self) -> int:
         await self.ping_server()
+        # Сервер после переподключения может оказаться другим, так что init всегда уходит кодеком по умолчанию
+        utils.negotiate_codec(None)
         init_response: Msg | None = await self.nc.request(
             subject="server.init",
-            payload=utils.pack_msg(InitMessage(username=settings.name)),
+            payload=utils.pack_msg(
+                InitMessage(username=settings.name, codecs=utils.supported_codecs())
+            ),
             timeout=10,
         )
 
         init_message = utils.unpack_msg(init_response, InitMessage)
         if init_message is None:
             raise DisconnectedException("Ошибка аутентификации")
+        codec = utils.negotiate_codec(init_message.codecs)
+        self.logger.info(f"Кодек сообщений: {codec}")
 
         self.logger.info(
             f"Пользователь {init_message.id}:{init_message.username} успешно подключен"
@@ -86,6 +98,9 @@ class AppContainer:
     # TODO: Причесать код, разделить на правильные сервисы и распараллеливать процесс отгрузки\парсинга
     async def run(self):
         self.parser = Parser()
+        self.metrics_service = MetricsService()
+        # Выгрузка метрик живёт дольше одной итерации: перезапуск сервисов её не трогает
+        self.metrics_task = asyncio.create_task(self.metrics_service.start())
         listener_process = None
         while True:
             tasks: list = []
@@ -113,14 +128,18 @@ class AppContainer:
                 await check_tables()
 
                 tasks.append(self.parser.start())
+                if not offline_mode:
+                    tasks.append(self.sender_service.start())
 
                 errors = await asyncio.gather(*tasks, return_exceptions=True)
                 for error in (e for e in errors if isinstance(e, Exception)):
                     self.logger.error(error)
 
-                listener_process.join()
+                if listener_process is not None:
+                    listener_process.join()
             except Exception as e:
                 self.logger.error(e)
             finally:
                 await asyncio.sleep(10)
-                listener_process.terminate()
+                if listener_process is not None:
+                    listener_process.terminate()
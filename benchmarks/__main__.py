@@ -0,0 +1,117 @@
+"""
+Микробенчмарки горячих путей клиента
+
+    python -m benchmarks [-s codec,queries,ingest,photos,export] [-r 10000,1000000] [-o results.json]
+
+Запускать из корня репозитория: работает офлайн на временных SQLite базах и каталоге фотографий,
+рабочие database.sqlite и photos не трогаются
+"""
+import asyncio
+import json
+import optparse
+import os
+import platform
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+SUITES = ("codec", "queries", "ingest", "photos", "export")
+
+
+def prepare_environment(workdir: Path):
+    # Настройки читаются лениво, поэтому достаточно выставить переменные до первого импорта database
+    os.environ["DYNACONF_DATABASE__url"] = f"sqlite+aiosqlite:///{workdir / 'database.sqlite'}"
+    os.environ["DYNACONF_PARSER__photos_dir"] = str(workdir / "photos")
+
+
+def compare(results: list[dict], baseline_file: str):
+    baseline = {
+        (result["name"], json.dumps(result["params"], sort_keys=True)): result
+        for result in json.loads(Path(baseline_file).read_text())["results"]
+    }
+    print(f"\nСравнение с {baseline_file}:")
+    for result in results:
+        previous = baseline.get((result["name"], json.dumps(result["params"], sort_keys=True)))
+        if previous is None or previous["ops_per_sec"] == 0:
+            continue
+        ratio = result["ops_per_sec"] / previous["ops_per_sec"]
+        print(f"\t{result['name']:<40} {result['params']}: x{ratio:.2f}")
+
+
+async def run_suites(suites: list[str], workdir: Path, options) -> list:
+    from database import check_tables
+    from benchmarks import bench_codec, bench_queries, bench_ingest, bench_photos, bench_export
+
+    await check_tables()
+    modules = {
+        "codec": bench_codec,
+        "queries": bench_queries,
+        "ingest": bench_ingest,
+        "photos": bench_photos,
+        "export": bench_export,
+    }
+    results = []
+    for suite in suites:
+        print(f"== {suite}")
+        for result in await modules[suite].run(
+            workdir=workdir,
+            rows=[int(rows) for rows in options.rows.split(",")],
+            iterations=options.iterations,
+            messages=options.messages,
+            photos=options.photos,
+        ):
+            print(result)
+            results.append(result)
+    return results
+
+
+def main():
+    parser = optparse.OptionParser(usage="python -m benchmarks [options]")
+    parser.add_option("-s", "--suites", dest="suites", default=",".join(SUITES))
+    parser.add_option("-r", "--rows", dest="rows", default="10000,1000000",
+                      help="Размеры таблицы numbers для запросов очереди")
+    parser.add_option("-i", "--iterations", dest="iterations", type="int", default=1000)
+    parser.add_option("-m", "--messages", dest="messages", type="int", default=20000,
+                      help="Количество сообщений для приёма задач")
+    parser.add_option("-p", "--photos", dest="photos", type="int", default=2000,
+                      help="Количество фотографий в архиве выгрузки")
+    parser.add_option("-w", "--workdir", dest="workdir",
+                      help="Каталог для временных баз (по умолчанию - временный)")
+    parser.add_option("-o", "--output", dest="output",
+                      default=f"benchmarks/results/{datetime.now():%Y%m%d_%H%M%S}.json")
+    parser.add_option("-c", "--compare", dest="compare", help="JSON предыдущего прогона")
+    (options, _) = parser.parse_args()
+
+    suites = [suite for suite in options.suites.split(",") if suite]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"Неизвестные наборы: {', '.join(unknown)}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(options.workdir or tmp).absolute()
+        workdir.mkdir(parents=True, exist_ok=True)
+        prepare_environment(workdir)
+        results = [result.dict() for result in asyncio.run(run_suites(suites, workdir, options))]
+
+    output = Path(options.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(
+        json.dumps(
+            {
+                "started_at": datetime.now().isoformat(),
+                "python": sys.version,
+                "platform": platform.platform(),
+                "results": results,
+            },
+            indent=2,
+            ensure_ascii=False,
+        )
+    )
+    print(f"\nРезультаты сохранены в {output}")
+    if options.compare:
+        compare(results, options.compare)
+
+
+if __name__ == "__main__":
+    main()
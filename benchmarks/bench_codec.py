@@ -0,0 +1,50 @@
+from pydantic import BaseModel
+
+import utils
+from benchmarks.common import BenchmarkResult, measure
+from handlers.heartbeat_handler import Ping
+
+
+class Payload(BaseModel):
+    numbers: list[str]
+
+
+class RawMsg:
+    def __init__(self, data: bytes):
+        self.data = data
+
+
+def payloads() -> dict[str, BaseModel]:
+    return {
+        "ping": Ping(id=42),
+        "1KB": Payload(numbers=[f"7900{index:07d}" for index in range(80)]),
+        "64KB": Payload(numbers=[f"7900{index:07d}" for index in range(5000)]),
+    }
+
+
+async def run(iterations: int, **_) -> list[BenchmarkResult]:
+    results = []
+    for size, payload in payloads().items():
+        for codec in (utils.RAW, utils.ZLIB, utils.LZMA, utils.LEGACY_LZMA):
+            packed = utils.pack_msg(payload, codec)
+            message = RawMsg(packed)
+            results.append(
+                measure(
+                    "utils.pack_msg",
+                    lambda: utils.pack_msg(payload, codec),
+                    iterations,
+                    payload=size,
+                    codec=codec,
+                    bytes=len(packed),
+                )
+            )
+            results.append(
+                measure(
+                    "utils.unpack_msg",
+                    lambda: utils.unpack_msg(message, type(payload)),
+                    iterations,
+                    payload=size,
+                    codec=codec,
+                )
+            )
+    return results
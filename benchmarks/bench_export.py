@@ -0,0 +1,45 @@
+import time
+from pathlib import Path
+
+from sqlalchemy import delete
+
+from benchmarks.bench_photos import screenshot
+from benchmarks.common import BenchmarkResult, summarize
+from database import get_session, insert_numbers, photo_store, Number, NumberStatus
+from services.zmq_listener_service import ZmqListenerService
+
+
+async def run(workdir: Path, photos: int, **_) -> list[BenchmarkResult]:
+    base_image = screenshot(96)
+    rows = []
+    for index in range(photos):
+        # Каждая фотография уникальна, чтобы в архив действительно писалось photos файлов
+        image_hash = await photo_store.put(base_image + index.to_bytes(4, "big"))
+        rows.append(
+            {
+                "number": f"8{index:010d}",
+                "status": NumberStatus.COMPLETED,
+                "image_hash": image_hash,
+            }
+        )
+    async with get_session() as session:
+        await session.execute(delete(Number))
+        await insert_numbers(session, rows)
+        await session.commit()
+
+    listener = ZmqListenerService()
+    timings = []
+    started = time.perf_counter()
+    for attempt in range(3):
+        start = time.perf_counter()
+        await listener.download(str(workdir / f"export_{attempt}.zip"), "")
+        timings.append(time.perf_counter() - start)
+    return [
+        summarize(
+            "ZmqListenerService.download",
+            timings,
+            time.perf_counter() - started,
+            ops=photos * len(timings),
+            photos=photos,
+        )
+    ]
@@ -0,0 +1,58 @@
+import logging
+import time
+
+from sqlalchemy import delete
+
+import utils
+from benchmarks.common import BenchmarkResult, summarize
+from database import get_session, Number
+from handlers.data_handler import DataHandler, NumberTask
+
+
+class FakeMsg:
+    """Минимальная замена nats.aio.msg.Msg: только то, что использует DataHandler"""
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def respond(self, data: bytes):
+        pass
+
+    async def ack(self):
+        pass
+
+
+async def run(messages: int, **_) -> list[BenchmarkResult]:
+    results = []
+    for batch_size in (1, 100, 500):
+        async with get_session() as session:
+            await session.execute(delete(Number))
+            await session.commit()
+
+        handler = DataHandler(logging.getLogger("DataHandler"))
+        handler.batch_size = batch_size
+        # Каждый третий номер - дубликат, как при повторной раздаче задач сервером
+        batch = [
+            FakeMsg(utils.pack_msg(NumberTask(id=index, number=f"7{index - index % 3:010d}")))
+            for index in range(messages)
+        ]
+
+        timings = []
+        started = time.perf_counter()
+        for msg in batch:
+            start = time.perf_counter()
+            await handler.handle_message(msg)
+            timings.append(time.perf_counter() - start)
+        await handler.flush()
+        if handler.flush_timer is not None:
+            handler.flush_timer.cancel()
+        results.append(
+            summarize(
+                "DataHandler.handle",
+                timings,
+                time.perf_counter() - started,
+                messages=messages,
+                batch_size=batch_size,
+            )
+        )
+    return results
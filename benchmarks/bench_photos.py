@@ -0,0 +1,77 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from types import SimpleNamespace
+
+from PIL import Image
+
+from benchmarks.common import BenchmarkResult, measure_async
+from database import Number, photo_store
+from parser.async_driver import AsyncDriver
+from parser.basic_parser_impl import BasicParserImpl, SOURCE
+from parser.image_processor import ImageProcessor, IMAGE_FORMATS
+
+
+def screenshot(size: int = 640, image_format: str = "PNG") -> bytes:
+    """Шумная картинка, похожая на скриншот аватарки по сжимаемости"""
+    image = Image.merge(
+        "RGB",
+        [
+            Image.linear_gradient("L").resize((size, size)),
+            Image.effect_noise((size, size), 48),
+            Image.linear_gradient("L").rotate(90).resize((size, size)),
+        ],
+    )
+    output = BytesIO()
+    image.save(output, image_format)
+    return output.getvalue()
+
+
+class SourceDriver:
+    """Отдаёт data URL как src аватарки, без сети"""
+
+    def __init__(self, image: bytes):
+        self.data_url = "data:image/jpeg;base64," + base64.b64encode(image).decode()
+
+    def execute_script(self, *_):
+        return self.data_url
+
+
+async def run(iterations: int, **_) -> list[BenchmarkResult]:
+    results = []
+    # Элемент с готовым скриншотом вместо WebElement: измеряем всё, что save_photo делает после захвата
+    element = SimpleNamespace(screenshot_as_png=screenshot())
+    driver = AsyncDriver(None, ThreadPoolExecutor(max_workers=1))
+    for image_format in IMAGE_FORMATS:
+        processor = ImageProcessor(image_format, 80, 0.5, 0, 1)
+        parser = BasicParserImpl(driver, "", 10, photo_store, processor)
+        number = Number(number="70000000000")
+        results.append(
+            await measure_async(
+                "BasicParserImpl.save_photo",
+                lambda: parser.save_photo(element, number),
+                max(iterations // 10, 10),
+                format=image_format,
+            )
+        )
+        results[-1].params["bytes"] = photo_store.path(number.image_hash).stat().st_size
+        processor.shutdown()
+    driver.executor.shutdown()
+
+    # Исходный JPEG аватарки: без скриншота и без перекодирования
+    driver = AsyncDriver(SourceDriver(screenshot(image_format="JPEG")), ThreadPoolExecutor(max_workers=1))
+    processor = ImageProcessor("WEBP", 80, 0.5, 0, 1)
+    parser = BasicParserImpl(driver, "", 10, photo_store, processor, photo_capture=SOURCE)
+    number = Number(number="70000000000")
+    results.append(
+        await measure_async(
+            "BasicParserImpl.save_photo",
+            lambda: parser.save_photo(element, number),
+            max(iterations // 10, 10),
+            format="source",
+        )
+    )
+    results[-1].params["bytes"] = photo_store.path(number.image_hash).stat().st_size
+    processor.shutdown()
+    driver.executor.shutdown()
+    return results
@@ -0,0 +1,84 @@
+import random
+import sqlite3
+import time
+from pathlib import Path
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.common import BenchmarkResult, measure_async
+from database import (
+    Base,
+    get_actual_number,
+    claim_numbers,
+    get_handled_numbers,
+    get_status,
+    get_throughput,
+    install_status_counters,
+)
+
+STATUSES = ["CREATED"] * 5 + ["COMPLETED"] * 3 + ["ERROR", "SECONDCHECK"]
+
+
+def populate(path: Path, rows: int, chunk_size: int = 50_000):
+    """Заполняет отдельную базу rows номерами в смешанных статусах (половина - оффлайн)"""
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        install_status_counters(conn)
+    engine.dispose()
+
+    rng = random.Random(rows)
+    connection = sqlite3.connect(path)
+    for start in range(0, rows, chunk_size):
+        batch = []
+        for index in range(start, min(start + chunk_size, rows)):
+            status = rng.choice(STATUSES)
+            batch.append(
+                (
+                    index if index % 2 else None,
+                    f"7{index:010d}",
+                    status,
+                    f"{index:064x}" if status == "COMPLETED" else None,
+                )
+            )
+        connection.executemany(
+            "insert into numbers (server_id, number, status, image_hash, attempts)"
+            " values (?, ?, ?, ?, 0)",
+            batch,
+        )
+        connection.commit()
+    connection.close()
+
+
+async def run(workdir: Path, rows: list[int], iterations: int, **_) -> list[BenchmarkResult]:
+    results = []
+    for row_count in rows:
+        path = workdir / f"queries_{row_count}.sqlite"
+        if not path.exists():
+            started = time.perf_counter()
+            populate(path, row_count)
+            print(f"База на {row_count} строк заполнена за {time.perf_counter() - started:.1f} с")
+
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        session_maker = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+        async with session_maker() as session:
+
+            async def claim():
+                await claim_numbers(session, 1, 60, offline=True)
+                await session.rollback()
+
+            benchmarks = [
+                ("get_actual_number", lambda: get_actual_number(session, offline=True), iterations),
+                ("claim_numbers", claim, iterations),
+                ("get_handled_numbers(5)", lambda: get_handled_numbers(session, 5), iterations),
+                ("get_handled_numbers(100)", lambda: get_handled_numbers(session, 100), iterations),
+                ("get_status", lambda: get_status(session), iterations),
+                ("get_throughput", lambda: get_throughput(session), iterations),
+            ]
+            for name, fn, count in benchmarks:
+                results.append(await measure_async(name, fn, count, rows=row_count))
+                session.expunge_all()
+        await engine.dispose()
+    return results
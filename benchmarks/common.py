@@ -0,0 +1,68 @@
+import statistics
+import time
+from typing import Callable, Awaitable, Any
+
+from pydantic import BaseModel
+
+
+class BenchmarkResult(BaseModel):
+    name: str
+    params: dict[str, Any] = {}
+    iterations: int
+    ops_per_sec: float
+    p50_ms: float
+    p99_ms: float
+
+    def __str__(self):
+        params = ", ".join(f"{key}={value}" for key, value in self.params.items())
+        return (
+            f"{self.name:<40} {params:<28} {self.ops_per_sec:>12.1f} ops/s"
+            f"   p50 {self.p50_ms:>9.3f} ms   p99 {self.p99_ms:>9.3f} ms"
+        )
+
+
+def summarize(
+    name: str, timings: list[float], total: float, ops: int | None = None, **params
+) -> BenchmarkResult:
+    """timings - длительности отдельных операций в секундах, total - общее время прогона"""
+    timings = sorted(timings)
+    return BenchmarkResult(
+        name=name,
+        params=params,
+        iterations=len(timings),
+        ops_per_sec=(ops if ops is not None else len(timings)) / total if total > 0 else 0,
+        p50_ms=statistics.median(timings) * 1000,
+        p99_ms=timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+    )
+
+
+def measure(
+    name: str, fn: Callable[[], Any], iterations: int, warmup: int = 10, **params
+) -> BenchmarkResult:
+    for _ in range(warmup):
+        fn()
+    timings = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return summarize(name, timings, time.perf_counter() - started, **params)
+
+
+async def measure_async(
+    name: str,
+    fn: Callable[[], Awaitable[Any]],
+    iterations: int,
+    warmup: int = 3,
+    **params,
+) -> BenchmarkResult:
+    for _ in range(warmup):
+        await fn()
+    timings = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        timings.append(time.perf_counter() - start)
+    return summarize(name, timings, time.perf_counter() - started, **params)
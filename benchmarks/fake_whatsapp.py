@@ -0,0 +1,312 @@
+"""
+Локальная подмена WhatsApp Web для воспроизводимых замеров парсера
+
+    python -m benchmarks.fake_whatsapp [-p 8765] [--error-rate 0.1] ...
+
+Страницы собираются из тех же xpath, что использует парсер (parser/xpaths.py), поэтому при их изменении
+подмена меняется вместе с ними. Задержки отрисовки и доли ошибок/зависаний/бизнес-аккаунтов настраиваются
+"""
+import html
+import json
+import optparse
+import random
+import re
+import threading
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from io import BytesIO
+from urllib.parse import urlparse, parse_qs
+
+from PIL import Image, ImageDraw
+from pydantic import BaseModel
+
+from parser.xpaths import (
+    qr_code_xpath,
+    user_header_xpath,
+    profile_button_xpath,
+    on_profile_second_xpath,
+    photo_xpath,
+    error_button_xpath,
+    business_photo_xpath,
+)
+
+VOID_TAGS = {"img"}
+STEP_RE = re.compile(r"^(\w+)(?:\[(\d+)])?$")
+ID_STEP_RE = re.compile(r'^\*\[@id="([^"]+)"]$')
+
+
+class FakeWhatsAppConfig(BaseModel):
+    render_delay_min: float = 0.3
+    render_delay_max: float = 1.5
+    drawer_delay: float = 0.3
+    log_in_delay: float = 1.0
+    error_rate: float = 0.1
+    hang_rate: float = 0.02
+    business_rate: float = 0.1
+    seed: int = 0
+
+
+class Node:
+    def __init__(self, tag: str, **attrs: str):
+        self.tag = tag
+        self.attrs = attrs
+        self.children: list["Node"] = []
+
+    def find_id(self, element_id: str) -> "Node | None":
+        if self.attrs.get("id") == element_id:
+            return self
+        for child in self.children:
+            found = child.find_id(element_id)
+            if found is not None:
+                return found
+        return None
+
+    def child(self, tag: str, index: int) -> "Node":
+        same_tag = [child for child in self.children if child.tag == tag]
+        while len(same_tag) < index:
+            node = Node(tag)
+            self.children.append(node)
+            same_tag.append(node)
+        return same_tag[index - 1]
+
+    def ensure(self, xpath: str) -> "Node":
+        """Достраивает дерево так, чтобы xpath вида //*[@id="x"]/div/span[2]/... указывал на существующий узел"""
+        steps = [step for step in xpath.split("/") if step]
+        element_id = ID_STEP_RE.match(steps[0]).group(1)
+        node = self.find_id(element_id)
+        if node is None:
+            node = Node("div", id=element_id)
+            self.children.append(node)
+        for step in steps[1:]:
+            tag, index = STEP_RE.match(step).groups()
+            node = node.child(tag, int(index or 1))
+        return node
+
+    def render(self) -> str:
+        attrs = "".join(f' {key}="{html.escape(value)}"' for key, value in self.attrs.items())
+        if self.tag in VOID_TAGS:
+            return f"<{self.tag}{attrs}>"
+        return f"<{self.tag}{attrs}>{''.join(child.render() for child in self.children)}</{self.tag}>"
+
+
+def build(*elements: tuple[str, dict[str, str]]) -> str:
+    body = Node("body")
+    for xpath, attrs in elements:
+        body.ensure(xpath).attrs.update(attrs)
+    return "".join(child.render() for child in body.children)
+
+
+def avatar(phone: str) -> dict[str, str]:
+    return {"src": f"/avatar/{phone}.jpg", "class": "avatar"}
+
+
+def templates(phone: str, previous: str | None = None) -> dict[str, str]:
+    """
+    Все состояния страницы одного номера, переключаются скриптом страницы
+        previous - номер, чья шторка профиля была открыта до перехода внутри приложения:
+        как и в WhatsApp Web, она остаётся на экране рядом с новым чатом (и на Escape не закрывается),
+        так что парсер должен отличать её от шторки нового номера
+    """
+    stale_drawer = (
+        ((on_profile_second_xpath, avatar(previous)), (photo_xpath, avatar(previous)))
+        if previous
+        else ()
+    )
+    return {
+        "qr": build((qr_code_xpath, {"width": "264", "height": "264", "data-qr": "1"})),
+        "logged_in": build((user_header_xpath, avatar("me"))),
+        "chat": build((profile_button_xpath, {"data-open": "drawer"}), *stale_drawer),
+        "business_chat": build(
+            (profile_button_xpath, {"data-open": "business_drawer"}), *stale_drawer
+        ),
+        "drawer": build(
+            (profile_button_xpath, {}),
+            (on_profile_second_xpath, avatar(phone)),
+            (photo_xpath, avatar(phone)),
+        ),
+        "business_drawer": build(
+            (profile_button_xpath, {}),
+            (business_photo_xpath, {"data-open": "drawer", "class": "button"}),
+        ),
+        "error": build((error_button_xpath, {"class": "button"}), *stale_drawer),
+        "hang": "",
+    }
+
+
+PAGE = r"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>WhatsApp</title>
+<style>
+  body * {{ display: block; min-height: 4px; min-width: 4px; }}
+  .avatar {{ width: 192px; height: 192px; }}
+  .button {{ width: 80px; height: 24px; background: #0a0; cursor: pointer; }}
+  header {{ height: 40px; background: #eee; cursor: pointer; }}
+</style></head>
+<body>
+<script>
+  let templates = {templates};
+  let phone = "{phone}";
+  let drawerPhone = null;
+  // Переход по ссылке на номер без перезагрузки, как это делает WhatsApp Web для ссылок wa.me.
+  // Старый чат остаётся на экране, пока не отрисуется новый
+  document.addEventListener("click", function (event) {{
+    const anchor = event.target.closest ? event.target.closest("a") : null;
+    const match = anchor ? anchor.href.match(/(?:wa\.me\/|phone=)(\d+)/) : null;
+    if (!match) {{ return; }}
+    event.preventDefault();
+    phone = match[1];
+    const previous = drawerPhone ? "&previous=" + drawerPhone : "";
+    fetch("/state?phone=" + phone + previous).then(function (response) {{ return response.json(); }})
+      .then(function (next) {{
+        templates = next.templates;
+        setTimeout(function () {{ show(next.state); }}, next.delay);
+      }});
+  }});
+  function show(state) {{
+    document.body.innerHTML = templates[state];
+    drawerPhone = state === "drawer" ? phone : null;
+    const qr = document.querySelector("[data-qr]");
+    if (qr) {{ qr.getContext("2d").fillRect(8, 8, 64, 64); }}
+    document.querySelectorAll("[data-open]").forEach(function (element) {{
+      element.addEventListener("click", function () {{
+        if ({drawer_delay} === 0) {{ show(element.dataset.open); return; }}
+        setTimeout(function () {{ show(element.dataset.open); }}, {drawer_delay});
+      }});
+    }});
+  }}
+  {script}
+</script>
+</body></html>"""
+
+
+class FakeWhatsApp:
+    config: FakeWhatsAppConfig
+    server: ThreadingHTTPServer
+    stats: dict[str, int]
+
+    def __init__(self, config: FakeWhatsAppConfig, host: str = "127.0.0.1", port: int = 0):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.stats = {
+            "chat": 0, "business_chat": 0, "error": 0, "hang": 0, "log_in": 0, "in_app": 0
+        }
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def pick_state(self) -> tuple[str, float]:
+        with self.lock:
+            roll = self.random.random()
+            delay = self.random.uniform(self.config.render_delay_min, self.config.render_delay_max)
+            if roll < self.config.hang_rate:
+                state = "hang"
+            elif roll < self.config.hang_rate + self.config.error_rate:
+                state = "error"
+            elif roll < self.config.hang_rate + self.config.error_rate + self.config.business_rate:
+                state = "business_chat"
+            else:
+                state = "chat"
+            self.stats[state] += 1
+        return state, delay
+
+    def page(self, phone: str, script: str) -> bytes:
+        return PAGE.format(
+            templates=json.dumps(templates(phone)).replace("</", "<\\/"),
+            drawer_delay=int(self.config.drawer_delay * 1000),
+            phone=phone,
+            script=script,
+        ).encode()
+
+    def log_in_page(self) -> bytes:
+        with self.lock:
+            self.stats["log_in"] += 1
+        return self.page(
+            "me",
+            f'show("qr"); setTimeout(function () {{ show("logged_in"); }}, '
+            f"{int(self.config.log_in_delay * 1000)});",
+        )
+
+    def chat_state(self, phone: str, previous: str | None) -> bytes:
+        state, delay = self.pick_state()
+        with self.lock:
+            self.stats["in_app"] += 1
+        return json.dumps(
+            {"state": state, "delay": int(delay * 1000), "templates": templates(phone, previous)}
+        ).encode()
+
+    def chat_page(self, phone: str) -> bytes:
+        state, delay = self.pick_state()
+        return self.page(phone, f'setTimeout(function () {{ show("{state}"); }}, {int(delay * 1000)});')
+
+    def handler_class(self) -> type[BaseHTTPRequestHandler]:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send(self, body: bytes, content_type: str = "text/html; charset=utf-8"):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == "/":
+                    self.send(fake.log_in_page())
+                elif url.path == "/send":
+                    self.send(fake.chat_page(parse_qs(url.query).get("phone", [""])[0]))
+                elif url.path == "/state":
+                    query = parse_qs(url.query)
+                    self.send(
+                        fake.chat_state(query.get("phone", [""])[0], query.get("previous", [None])[0]),
+                        "application/json",
+                    )
+                elif url.path.startswith("/avatar/"):
+                    self.send(avatar_jpeg(url.path[len("/avatar/"):-len(".jpg")]), "image/jpeg")
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+    def start(self) -> "FakeWhatsApp":
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@lru_cache(maxsize=1024)
+def avatar_jpeg(phone: str, size: int = 640) -> bytes:
+    color = tuple(random.Random(phone).randrange(256) for _ in range(3))
+    image = Image.new("RGB", (size, size), color)
+    ImageDraw.Draw(image).ellipse((size // 4, size // 4, size * 3 // 4, size * 3 // 4), fill="white")
+    output = BytesIO()
+    image.save(output, "JPEG", quality=85)
+    return output.getvalue()
+
+
+def main():
+    parser = optparse.OptionParser(usage="python -m benchmarks.fake_whatsapp [options]")
+    parser.add_option("-p", "--port", dest="port", type="int", default=8765)
+    for name, field in FakeWhatsAppConfig.__fields__.items():
+        parser.add_option(f"--{name.replace('_', '-')}", dest=name, type=field.type_.__name__,
+                          default=field.default)
+    (options, _) = parser.parse_args()
+    config = FakeWhatsAppConfig(
+        **{name: getattr(options, name) for name in FakeWhatsAppConfig.__fields__}
+    )
+    fake = FakeWhatsApp(config, port=options.port)
+    print(f"Подмена WhatsApp Web слушает {fake.url}")
+    fake.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Сквозной замер пропускной способности настоящего Parser на локальной подмене WhatsApp Web
+
+    python -m benchmarks.parser_throughput --chromedriver /path/to/chromedriver [-n 200] [-t 2] [-o result.json]
+
+Chrome запускается headless с временным профилем, база и фотографии тоже временные
+"""
+import asyncio
+import json
+import optparse
+import os
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks.fake_whatsapp import FakeWhatsApp, FakeWhatsAppConfig
+
+
+def prepare_environment(workdir: Path, fake: FakeWhatsApp, options):
+    # Настройки читаются лениво, поэтому достаточно выставить переменные до первого импорта database/parser
+    os.environ.update(
+        {
+            "DYNACONF_ENABLE_OFFLINE_MODE": "true",
+            "DYNACONF_DATABASE__url": f"sqlite+aiosqlite:///{workdir / 'database.sqlite'}",
+            "DYNACONF_PARSER__photos_dir": str(workdir / "photos"),
+            "DYNACONF_PARSER__url": fake.url + "/send?phone={0}",
+            "DYNACONF_PARSER__log_in_url": fake.url + "/",
+            "DYNACONF_PARSER__tabs": str(options.tabs),
+            "DYNACONF_PARSER__webdriver_timeout": str(options.webdriver_timeout),
+            "DYNACONF_PARSER__navigation__mode": options.navigation,
+            # Резервный браузер удвоил бы потребление памяти в отчёте
+            "DYNACONF_PARSER__browser__standby": "false",
+            "DYNACONF_SELENIUM__headless": "true",
+            "DYNACONF_SELENIUM__headless_mode": "new",
+            "DYNACONF_SELENIUM__chromedriver_path": str(Path(options.chromedriver).absolute()),
+            "DYNACONF_SELENIUM__chromedriver_data_dir": str(workdir / "chromedriver_data"),
+            "DYNACONF_SELENIUM__log_in_screen_filename": str(workdir / "log_in_screen.png"),
+        }
+    )
+
+
+async def run(count: int, max_duration: float) -> dict:
+    from sqlalchemy import select, func
+
+    from database import check_tables, get_session, insert_numbers, count_backlog, Number
+    from parser.parser import Parser
+
+    await check_tables()
+    async with get_session() as session:
+        await insert_numbers(session, [{"number": f"7900{index:07d}"} for index in range(count)])
+        await session.commit()
+
+    parser = Parser()
+    started = time.perf_counter()
+    try:
+        while time.perf_counter() - started < max_duration:
+            await parser.parse()
+            if parser.driver is None:
+                # Браузер не поднялся или упал - parse() уже записал причину в лог
+                await asyncio.sleep(1)
+                continue
+            async with get_session() as session:
+                if await count_backlog(session, offline=True) == 0:
+                    break
+    finally:
+        elapsed = time.perf_counter() - started
+        navigation = parser.navigation_stats()
+        browser = parser.browser_stats()
+        recovery = parser.recovery_stats
+        await parser.shutdown()
+
+    async with get_session() as session:
+        statuses = {
+            status.name: total
+            for status, total in (
+                await session.execute(select(Number.status, func.count()).group_by(Number.status))
+            ).all()
+        }
+    finished = statuses.get("COMPLETED", 0) + statuses.get("ERROR", 0)
+    return {
+        "numbers": count,
+        "elapsed_sec": elapsed,
+        "numbers_per_minute": finished / elapsed * 60 if elapsed > 0 else 0,
+        "statuses": statuses,
+        "navigation": navigation,
+        "browser": browser,
+        "recovery": recovery,
+    }
+
+
+def main():
+    parser = optparse.OptionParser(usage="python -m benchmarks.parser_throughput [options]")
+    parser.add_option("--chromedriver", dest="chromedriver", default="chromedriver")
+    parser.add_option("-n", "--numbers", dest="numbers", type="int", default=100)
+    parser.add_option("-t", "--tabs", dest="tabs", type="int", default=1)
+    parser.add_option("--webdriver-timeout", dest="webdriver_timeout", type="int", default=5)
+    parser.add_option("--navigation", dest="navigation", default="in_app", help="in_app или reload")
+    parser.add_option("--max-duration", dest="max_duration", type="float", default=1800)
+    parser.add_option("-o", "--output", dest="output",
+                      default=f"benchmarks/results/parser_{datetime.now():%Y%m%d_%H%M%S}.json")
+    for name, field in FakeWhatsAppConfig.__fields__.items():
+        parser.add_option(f"--{name.replace('_', '-')}", dest=name, type=field.type_.__name__,
+                          default=field.default)
+    (options, _) = parser.parse_args()
+
+    config = FakeWhatsAppConfig(
+        **{name: getattr(options, name) for name in FakeWhatsAppConfig.__fields__}
+    )
+    fake = FakeWhatsApp(config).start()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            prepare_environment(Path(tmp), fake, options)
+            result = asyncio.run(run(options.numbers, options.max_duration))
+    finally:
+        fake.stop()
+
+    result.update(
+        {
+            "started_at": datetime.now().isoformat(),
+            "tabs": options.tabs,
+            "navigation_mode": options.navigation,
+            "webdriver_timeout": options.webdriver_timeout,
+            "fake": config.dict(),
+            "served": fake.stats,
+        }
+    )
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+    output = Path(options.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
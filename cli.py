@@ -1,9 +1,12 @@
 import contextlib
+import gzip
 import logging
 import optparse
 import re
+import time
+from datetime import timedelta
 from pathlib import Path
-from typing import Iterator, Optional
+from typing import Iterable, Iterator, Optional, TextIO
 from config import settings
 
 import msgpack
@@ -11,83 +14,177 @@ import zmq
 from pydantic import BaseModel
 
 import log
+import metrics
 
 
 class StatusModel(BaseModel):
     total: int
     completed: int
     error: int
+    secondcheck: int = 0
+    in_progress: int = 0
+    throughput: float = 0
+    eta: Optional[float] = None
 
     def __str__(self):
-        return f"Status:\n\tTotal:\t{self.total}\n\tCompleted:\t{self.completed}\n\tError:\t{self.error}\n"
+        eta = str(timedelta(seconds=round(self.eta))) if self.eta is not None else "-"
+        return (
+            f"Status:\n\tTotal:\t{self.total}\n\tCompleted:\t{self.completed}\n\tError:\t{self.error}\n"
+            f"\tSecondcheck:\t{self.secondcheck}\n\tIn progress:\t{self.in_progress}\n"
+            f"\tThroughput:\t{self.throughput:.1f}/min\n\tETA:\t{eta}\n"
+        )
 
 
 class ResponseModel(BaseModel):
     status: str
     command: Optional[str]
+    data: Optional[dict]
 
     def __str__(self):
         return f"\nStatus: {self.status}\n\tCommand: {self.command}\n"
 
 
 @contextlib.contextmanager
-def create_socket(ctx: zmq.Context) -> Iterator[zmq.Socket]:
+def create_socket(
+    ctx: zmq.Context, recv_timeout: int = 10000, socket_type: int = zmq.REQ
+) -> Iterator[zmq.Socket]:
     port: int = settings.zmq.port
-    socket = ctx.socket(zmq.REQ)
-    socket.set(zmq.RCVTIMEO, 10000)
+    socket = ctx.socket(socket_type)
+    socket.set(zmq.RCVTIMEO, recv_timeout)
     socket.set(zmq.SNDTIMEO, 10000)
+    socket.set(zmq.LINGER, 0)
     with socket.connect(f"tcp://127.0.0.1:{port}"):
         yield socket
 
 
+def request(socket: zmq.Socket, command: str, data: dict | list | None = None) -> ResponseModel:
+    message = {"command": command} if data is None else {"command": command, "data": data}
+    socket.send(msgpack.packb(message))
+    return ResponseModel.parse_obj(msgpack.unpackb(socket.recv()))
+
+
 def download(ctx: zmq.Context, filename: str, password: str):
+    """Запускает выгрузку фоновым заданием и опрашивает его прогресс, пока оно не закончится"""
     logger = logging.getLogger("DOWNLOAD")
     with create_socket(ctx) as socket:  # type: zmq.Socket
-        socket.send(
-            msgpack.packb(
-                {
-                    "command": "download",
-                    "data": {"filename": filename, "password": password},
-                }
-            )
-        )
-
-        response = ResponseModel.parse_obj(msgpack.unpackb(socket.recv()))
+        response = request(socket, "download", {"filename": filename, "password": password})
         if response.status == "ERR":
             logger.error(response)
-        else:
-            logger.info(response)
+            return
+        job_id = response.data["id"]
+        logger.info(f"Выгрузка запущена, задание {job_id}")
 
+        while True:
+            time.sleep(settings.zmq.job_poll_interval)
+            response = request(socket, "job", {"id": job_id})
+            if response.status == "ERR":
+                logger.error(response)
+                return
+            job = response.data
+            progress = job["progress"]
+            if "total" in progress:
+                logger.info(f"Выгружено {progress['exported']} из {progress['total']} фотографий")
+            if job["state"] == "failed":
+                logger.error(f"Выгрузка не удалась: {job['error']}")
+                return
+            if job["state"] == "done":
+                logger.info(f"Архив {filename} готов")
+                return
 
-def upload(ctx: zmq.Context, filename: str):
-    logger = logging.getLogger("UPLOAD")
-    phone_regex: re.Pattern = re.compile(r"(\+?)[1-9][0-9]{7,14}")
 
-    with create_socket(ctx) as socket:  # type: zmq.Socket
-        buffer = []
+PHONE_RE = re.compile(r"\+?([1-9][0-9]{7,14})")
+CELL_SEPARATORS = re.compile(r"[,;\t]")
+
+
+def open_numbers_file(filename: str) -> TextIO:
+    path = Path(filename).absolute()
+    with open(path, "rb") as file:
+        gzipped = file.read(2) == b"\x1f\x8b"
+    if gzipped:
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def read_numbers(file: TextIO) -> Iterator[str | None]:
+    """
+    Построчно достаёт номера из текстового файла или CSV (разделители , ; и табуляция)
+        Из строки берётся первая ячейка, целиком похожая на номер, "+" отбрасывается.
+        Для строк без номера отдаёт None, пустые строки пропускает
+    """
+    for line in file:
+        line = line.strip()
+        if line == "":
+            continue
+        for cell in CELL_SEPARATORS.split(line):
+            match = PHONE_RE.fullmatch(cell.strip().strip('"'))
+            if match is not None:
+                yield match.group(1)
+                break
+        else:
+            yield None
+
+
+def read_chunks(filename: str, chunk_size: int, totals: dict[str, int]) -> Iterator[list[str]]:
+    """Номера из файла пачками по chunk_size, строки без номера считаются в totals["invalid"]"""
+    buffer = []
+    with open_numbers_file(filename) as file:
+        for number in read_numbers(file):
+            if number is None:
+                totals["invalid"] += 1
+                continue
+            buffer.append(number)
+            if len(buffer) >= chunk_size:
+                yield buffer
+                buffer = []
+    if len(buffer) > 0:
+        yield buffer
+
+
+def send_pipelined(socket: zmq.Socket, chunks: Iterable[list[str]], pipeline: int, totals: dict[str, int]):
+    """Отправляет пачки, держа в полёте не больше pipeline без ответа, и суммирует ответы в totals"""
+
+    def receive():
+        # Первый кадр - пустой разделитель, который добавляет/ожидает REP на стороне сервиса
+        response = ResponseModel.parse_obj(msgpack.unpackb(socket.recv_multipart()[-1]))
+        if response.status == "ERR":
+            raise RuntimeError(f"Ошибка сервера: {response.command}")
+        for key, value in (response.data or {}).items():
+            totals[key] += value
+
+    in_flight = 0
+    for chunk in chunks:
+        if in_flight >= pipeline:
+            receive()
+            in_flight -= 1
+        socket.send_multipart([b"", msgpack.packb({"command": "upload", "data": chunk})])
+        in_flight += 1
+    while in_flight > 0:
+        receive()
+        in_flight -= 1
 
-        def send_buffer():
-            socket.send(msgpack.packb({"command": "upload", "data": buffer}))
-            response: ResponseModel = ResponseModel.parse_obj(
-                msgpack.unpackb(socket.recv())
-            )
-            if response.status == "ERR":
-                raise RuntimeError(f"Ошибка сервера: {response.command}")
 
-        with open(Path(filename).absolute(), "r") as file:
-            for line in file:
-                if phone_regex.match(line):
-                    if len(buffer) >= 16:
-                        send_buffer()
-                        buffer.clear()
-                    else:
-                        buffer.append(line)
-                else:
-                    logger.warning(f"Номера: {buffer} не загружены")
-                    buffer.clear()
+def upload(ctx: zmq.Context, filename: str):
+    """
+    Потоково загружает номера пачками по settings.zmq.upload_chunk_size
+        DEALER-сокет держит в полёте до settings.zmq.upload_pipeline пачек, поэтому чтение файла,
+        передача и вставка на стороне клиента идут одновременно, а не по одному запросу
+    """
+    logger = logging.getLogger("UPLOAD")
+    totals = {"accepted": 0, "duplicate": 0, "invalid": 0}
+
+    started = time.perf_counter()
+    with create_socket(ctx, recv_timeout=60000, socket_type=zmq.DEALER) as socket:  # type: zmq.Socket
+        send_pipelined(
+            socket,
+            read_chunks(filename, settings.zmq.upload_chunk_size, totals),
+            settings.zmq.upload_pipeline,
+            totals,
+        )
 
-            if len(buffer) > 0:
-                send_buffer()
+    logger.info(
+        f"Загрузка завершена за {time.perf_counter() - started:.1f} с: добавлено {totals['accepted']},"
+        f" дубликатов {totals['duplicate']}, невалидных строк {totals['invalid']}"
+    )
 
 
 def status(ctx: zmq.Context):
@@ -103,6 +200,43 @@ def status(ctx: zmq.Context):
             logger.error(response)
 
 
+def format_metrics(snapshot: dict) -> str:
+    """Счётчики как есть, гистограммы - количество, среднее и оценки p50/p95 по корзинам (в мс)"""
+    lines = ["Metrics:"]
+    age = snapshot.get("snapshot_age")
+    if age is None:
+        lines.append("\tСнимка основного процесса ещё нет")
+    else:
+        lines.append(f"\tСнимок основного процесса: {age:.0f} с назад")
+    for key, value in sorted(snapshot["counters"].items()):
+        lines.append(f"\t{key}\t{value:g}")
+    for key, histogram in sorted(snapshot["histograms"].items()):
+        count = histogram["count"]
+        if count == 0:
+            continue
+        last_bound = histogram["buckets"][-1][0]
+
+        def bound(q: float) -> str:
+            value = metrics.quantile(histogram, q)
+            return f">{last_bound * 1000:g}ms" if value > last_bound else f"<={value * 1000:g}ms"
+
+        lines.append(
+            f"\t{key}\tcount={count}\tmean={histogram['sum'] / count * 1000:.0f}ms"
+            f"\tp50{bound(0.5)}\tp95{bound(0.95)}"
+        )
+    return "\n".join(lines) + "\n"
+
+
+def show_metrics(ctx: zmq.Context):
+    logger = logging.getLogger("METRICS")
+    with create_socket(ctx) as socket:  # type: zmq.Socket
+        response = request(socket, "metrics")
+        if response.status == "ERR":
+            logger.error(response)
+            return
+        logger.info(format_metrics(response.data))
+
+
 def main():
     log.init_logging()
     logger = logging.getLogger("MAIN")
@@ -129,7 +263,7 @@ def main():
         "-f",
         "--filename",
         dest="filename",
-        help="Название файла из которого будут выгружены номера",
+        help="Файл с номерами: по номеру на строку или CSV, можно сжатый gzip",
     )
 
     main_parser.add_option(
@@ -137,14 +271,22 @@ def main():
         "--status",
         dest="status",
         action="store_true",
-        help="Получить статус парсинга (может пока не очень работать)",
+        help="Получить статус парсинга",
+    )
+
+    main_parser.add_option(
+        "-m",
+        "--metrics",
+        dest="metrics",
+        action="store_true",
+        help="Получить метрики этапов парсинга, приёма и отправки",
     )
 
     main_parser.add_option_group(download_group)
     main_parser.add_option_group(upload_group)
 
     (options, arguments) = main_parser.parse_args()
-    if not any([options.download, options.upload, options.status]):
+    if not any([options.download, options.upload, options.status, options.metrics]):
         main_parser.print_help()
         return
 
@@ -167,6 +309,9 @@ def main():
         if options.status:
             status(ctx)
             return
+        if options.metrics:
+            show_metrics(ctx)
+            return
 
         main_parser.print_help()
     except Exception as e:
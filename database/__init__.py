@@ -1,25 +1,137 @@
 import contextlib
-from typing import Sequence
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import AsyncIterator, Sequence
 
-from sqlalchemy import select, or_, and_, text, Row
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from sqlalchemy import select, update, or_, and_, func, text, true, inspect, event, Row, Connection
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncConnection, AsyncEngine
 from sqlalchemy.orm import sessionmaker
 
 from config import settings
 from database.base import Base
 from database.number import NumberStatus, Number
+from database.photo_store import PhotoStore
+from database.status_counter import (
+    StatusCounter,
+    ThroughputBucket,
+    install_status_counters,
+    ONLINE,
+    OFFLINE,
+)
+from database.uploaded_photo import UploadedPhoto
+from database.writer import DatabaseWriter
 
-engine = create_async_engine(settings.database.url)
+ALEMBIC_INI = Path(__file__).parent.parent / "alembic.ini"
+# Ревизия, которой соответствует схема баз, созданных до появления миграций
+BASELINE_REVISION = "0001"
+
+PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size", "busy_timeout")
+
+
+def configure_sqlite(async_engine: AsyncEngine, immediate: bool = False) -> AsyncEngine:
+    """
+    Выставляет прагмы из settings.database на каждое новое соединение.
+        В режиме WAL читатели обоих процессов не блокируют писателя и друг друга.
+        immediate включает явное управление транзакциями: BEGIN IMMEDIATE берёт блокировку записи сразу,
+        а не при первом UPDATE посреди транзакции, и делает рабочими SAVEPOINT'ы
+    """
+    if async_engine.dialect.name != "sqlite":
+        return async_engine
+
+    @event.listens_for(async_engine.sync_engine, "connect")
+    def on_connect(dbapi_connection, _):
+        if immediate:
+            dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in PRAGMAS:
+            value = settings.database.get(pragma)
+            if value is not None:
+                cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+
+    if immediate:
+        @event.listens_for(async_engine.sync_engine, "begin")
+        def on_begin(conn):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return async_engine
+
+
+engine = configure_sqlite(create_async_engine(settings.database.url))
 async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+# Отдельный движок с одним соединением только для записи, см. DatabaseWriter
+writer_engine = configure_sqlite(
+    create_async_engine(settings.database.url, pool_size=1, max_overflow=0), immediate=True
+)
+writer = DatabaseWriter(
+    sessionmaker(writer_engine, expire_on_commit=False, class_=AsyncSession),
+    settings.database.writer.batch_size,
+    settings.database.writer.batch_delay,
+)
+photo_store: PhotoStore = PhotoStore(settings.parser.photos_dir)
+
+
+def migrate(conn: Connection):
+    """
+    Приводит схему базы к последней ревизии alembic (см. alembic/versions)
+        Новая база создаётся сразу по моделям и помечается последней ревизией. База старой версии клиента,
+        в которой таблицы уже есть, а alembic ещё не было, помечается первой ревизией и обновляется миграциями
+    """
+    config = Config(ALEMBIC_INI)
+    config.set_main_option("script_location", str(ALEMBIC_INI.parent / "alembic"))
+    config.attributes["connection"] = conn
+    if MigrationContext.configure(conn).get_current_revision() is None:
+        if not inspect(conn).has_table(Number.__tablename__):
+            Base.metadata.create_all(conn)
+            command.stamp(config, "head")
+            return
+        command.stamp(config, BASELINE_REVISION)
+    command.upgrade(config, "head")
+
+
+async def move_images_to_store(conn: AsyncConnection, chunk_size: int = 500):
+    """Переносит фотографии, которые старые версии клиента хранили BLOB'ами в numbers.image, в PhotoStore"""
+    columns = await conn.run_sync(
+        lambda sync_conn: inspect(sync_conn).get_columns(Number.__tablename__)
+    )
+    if "image" not in {column["name"] for column in columns}:
+        return
+    while True:
+        rows = (
+            await conn.execute(
+                text(
+                    "select id, image from numbers where image is not null limit :limit"
+                ),
+                {"limit": chunk_size},
+            )
+        ).all()
+        if len(rows) == 0:
+            return
+        for row_id, image in rows:
+            await conn.execute(
+                text("update numbers set image_hash = :hash, image = null where id = :id"),
+                {"hash": await photo_store.put(image), "id": row_id},
+            )
 
 
 async def check_tables():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        counters_exist = await conn.run_sync(
+            lambda sync_conn: inspect(sync_conn).has_table(StatusCounter.__tablename__)
+        )
+        await conn.run_sync(migrate)
+        await conn.run_sync(install_status_counters, not counters_exist)
+        await move_images_to_store(conn)
 
 
 @contextlib.asynccontextmanager
 async def get_session() -> AsyncSession:
+    # Сессии для чтения. Всё, что пишет в базу, отправляется через writer.submit
     async with async_session() as session:
         yield session
 
@@ -46,6 +158,74 @@ async def get_actual_number(
     ).scalar_one_or_none()
 
 
+async def claim_numbers(
+    session: AsyncSession,
+    limit: int,
+    lease_timeout: float,
+    offline: bool = False,
+) -> Sequence[Number]:
+    """
+    Атомарно забирает до limit номеров в работу: переводит их в IN_PROGRESS и выставляет срок аренды.
+        Номера с истекшей арендой (воркер упал или был перезапущен посреди парсинга) забираются повторно,
+        такой повтор не считается попыткой: attempts растёт только при ошибке парсинга (см. BasicParserImpl.parse).
+        Выборка и обновление выполняются одним UPDATE ... RETURNING, поэтому параллельные воркеры
+        никогда не получат один и тот же номер. Изменения нужно закоммитить сразу после вызова
+    """
+    now = datetime.utcnow()
+    claimable = (
+        select(Number.id)
+        .where(
+            and_(
+                or_(
+                    Number.status == NumberStatus.CREATED,
+                    Number.status == NumberStatus.SECONDCHECK,
+                    and_(
+                        Number.status == NumberStatus.IN_PROGRESS,
+                        Number.lease_expires_at < now,
+                    ),
+                ),
+                (Number.server_id.is_not(None) if not offline else true()),
+            )
+        )
+        .order_by(Number.status)
+        .limit(limit)
+    )
+    return (
+        await session.scalars(
+            update(Number)
+            .where(Number.id.in_(claimable))
+            .values(
+                status=NumberStatus.IN_PROGRESS,
+                lease_expires_at=now + timedelta(seconds=lease_timeout),
+            )
+            .returning(Number),
+            execution_options={"synchronize_session": False},
+        )
+    ).all()
+
+
+async def save_results(session: AsyncSession, numbers: Sequence[Number]):
+    """
+    Записывает итог парсинга номеров, взятых через claim_numbers, и снимает с них аренду
+        Объекты к этому моменту отвязаны от сессии, поэтому пишем UPDATE по первичному ключу
+    """
+    if len(numbers) == 0:
+        return
+    await session.execute(
+        update(Number),
+        [
+            {
+                "id": number.id,
+                "status": number.status,
+                "image_hash": number.image_hash,
+                "attempts": number.attempts,
+                "lease_expires_at": None,
+            }
+            for number in numbers
+        ],
+    )
+
+
 async def get_handled_numbers(
     session: AsyncSession, limit: int = 1_000_000_000, offline: bool = False
 ) -> Sequence[Number]:
@@ -59,7 +239,7 @@ async def get_handled_numbers(
                             Number.status == NumberStatus.COMPLETED,
                             Number.status == NumberStatus.ERROR,
                         ),
-                        (Number.server_id is not None if not offline else True),
+                        (Number.server_id.is_not(None) if not offline else true()),
                     )
                 )
                 .limit(limit)
@@ -70,15 +250,131 @@ async def get_handled_numbers(
     )
 
 
-async def get_status(session: AsyncSession) -> Row:
-    return (
+def handled_images_filter(offline: bool):
+    return and_(
+        or_(
+            Number.status == NumberStatus.COMPLETED,
+            Number.status == NumberStatus.ERROR,
+        ),
+        Number.image_hash.is_not(None),
+        (Number.server_id.is_not(None) if not offline else true()),
+    )
+
+
+async def count_handled_images(session: AsyncSession, offline: bool = False) -> int:
+    return await session.scalar(
+        select(func.count(Number.id)).where(handled_images_filter(offline))
+    )
+
+
+async def iter_handled_images(
+    session: AsyncSession, chunk_size: int = 1000, offline: bool = False
+) -> AsyncIterator[Sequence[Row]]:
+    """
+    Отдаёт пары (number, image_hash) обработанных номеров пачками по chunk_size
+        Строки читаются курсором на стороне базы (yield_per), так что в памяти не больше одной пачки
+    """
+    result = await session.stream(
+        select(Number.number, Number.image_hash)
+        .where(handled_images_filter(offline))
+        .order_by(Number.id)
+        .execution_options(yield_per=chunk_size)
+    )
+    async for partition in result.partitions():
+        yield partition
+
+
+async def insert_numbers(
+    session: AsyncSession, rows: list[dict], chunk_size: int = 5000
+) -> int:
+    """
+    Вставляет номера пачкой через INSERT OR IGNORE, дубликаты отсекаются самой базой
+        Один подготовленный запрос на все строки (executemany) вместо огромного многострочного VALUES,
+        который SQLAlchemy пришлось бы компилировать заново под каждую пачку.
+        Возвращает количество реально добавленных строк
+    """
+    if len(rows) == 0:
+        return 0
+    conn = await session.connection()
+    statement = sqlite_insert(Number.__table__).on_conflict_do_nothing(
+        index_elements=[Number.number]
+    )
+    inserted = 0
+    for start in range(0, len(rows), chunk_size):
+        inserted += (await conn.execute(statement, rows[start:start + chunk_size])).rowcount
+    return inserted
+
+
+async def count_backlog(session: AsyncSession, offline: bool = False) -> int:
+    """
+    Количество номеров, которые ещё предстоит распарсить (включая взятые в работу)
+        Читается из счётчиков StatusCounter, а не COUNT(*) по numbers: приём задач спрашивает его постоянно.
+        offline=False - только номера от сервера, offline=True - все номера
+    """
+    return await session.scalar(
+        select(func.coalesce(func.sum(StatusCounter.count), 0)).where(
+            and_(
+                StatusCounter.status.in_(
+                    (
+                        NumberStatus.CREATED.name,
+                        NumberStatus.IN_PROGRESS.name,
+                        NumberStatus.SECONDCHECK.name,
+                    )
+                ),
+                (StatusCounter.mode == ONLINE if not offline else true()),
+            )
+        )
+    )
+
+
+async def get_uploaded_hashes(session: AsyncSession, hashes: set[str]) -> set[str]:
+    return set(
+        (
+            await session.scalars(
+                select(UploadedPhoto.image_hash).where(
+                    UploadedPhoto.image_hash.in_(hashes)
+                )
+            )
+        ).all()
+    )
+
+
+async def mark_uploaded(session: AsyncSession, hashes: set[str]):
+    if len(hashes) == 0:
+        return
+    await session.execute(
+        sqlite_insert(UploadedPhoto)
+        .values([{"image_hash": photo_hash} for photo_hash in hashes])
+        .on_conflict_do_nothing()
+    )
+
+
+async def get_status(session: AsyncSession, offline: bool = True) -> dict[NumberStatus, int]:
+    """Количество номеров по статусам из счётчиков, которые ведут триггеры (см. StatusCounter)"""
+    counts = dict.fromkeys(NumberStatus, 0)
+    for status, count in (
+        await session.execute(
+            select(StatusCounter.status, StatusCounter.count).where(
+                StatusCounter.mode == (OFFLINE if offline else ONLINE)
+            )
+        )
+    ).all():
+        counts[NumberStatus[status]] = count
+    return counts
+
+
+async def get_throughput(session: AsyncSession, offline: bool = True, window: int = 15) -> float:
+    """Средняя скорость обработки (номеров в минуту) за последние window минут"""
+    now = int(time.time()) // 60
+    first, handled = (
         await session.execute(
-            text(
-                """select
-            (select count(1) from numbers where server_id is NULL),
-            (select count(1) from numbers where server_id is NULL and status like 'COMPLETED'),
-            (select count(1) from numbers where server_id is NULL and status like 'ERROR')
-        """
+            select(func.min(ThroughputBucket.minute), func.sum(ThroughputBucket.handled)).where(
+                ThroughputBucket.mode == (OFFLINE if offline else ONLINE),
+                ThroughputBucket.minute > now - window,
             )
         )
     ).one()
+    if first is None:
+        return 0.0
+    # Сразу после старта окно короче window, иначе скорость была бы занижена
+    return handled / (now - first + 1)
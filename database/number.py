@@ -1,6 +1,8 @@
 import enum
+from datetime import datetime
 from typing import Optional
 
+from sqlalchemy import Index, String
 from sqlalchemy.orm import mapped_column, Mapped
 
 from database.base import Base
@@ -8,6 +10,7 @@ from database.base import Base
 
 class NumberStatus(enum.Enum):
     CREATED = 0
+    IN_PROGRESS = 1
     COMPLETED = 2
     SECONDCHECK = 3
     ERROR = 4
@@ -15,9 +18,18 @@ class NumberStatus(enum.Enum):
 
 class Number(Base):
     __tablename__ = "numbers"
+    __table_args__ = (
+        # Покрывает выборку очереди в claim_numbers целиком, без обращения к строкам таблицы
+        Index("ix_numbers_status_server_id", "status", "server_id", "lease_expires_at"),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     server_id: Mapped[Optional[int]] = mapped_column(nullable=True)
     number: Mapped[str] = mapped_column(unique=True)
     status: Mapped[NumberStatus] = mapped_column(default=NumberStatus.CREATED)
-    image: Mapped[bytes] = mapped_column(nullable=True)
+    # sha256 фотографии в PhotoStore, сами байты лежат на диске в settings.parser.photos_dir
+    image_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, index=True)
+    # Номер взят воркером в работу до этого момента (UTC), после истечения его можно забрать снова
+    lease_expires_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+    # Сколько раз парсинг номера завершился ошибкой: после первой номер уходит в SECONDCHECK, после второй - в ERROR
+    attempts: Mapped[int] = mapped_column(default=0, server_default="0")
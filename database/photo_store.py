@@ -0,0 +1,103 @@
+import contextlib
+import hashlib
+import mmap
+import os
+import uuid
+from pathlib import Path
+from typing import Iterator
+
+import aiofiles
+import aiofiles.os
+
+
+class PhotoStore:
+    """
+    Хранилище фотографий на диске с адресацией по содержимому
+        Файл лежит по пути <root>/<hash[:2]>/<hash[2:4]>/<hash>, где hash - sha256 содержимого.
+        В таблице numbers хранится только хеш, поэтому очередь не таскает за собой мегабайты картинок,
+        а одинаковые фотографии занимают место один раз.
+        Фотография, на которую ещё не ссылается ни одна закоммиченная строка (put(hold=True) до release),
+        удерживается и не удаляется discard, иначе отправитель мог бы стереть файл, который парсер
+        только что переиспользовал, но ещё не записал в базу. Удержание действует внутри процесса -
+        удаляет фотографии только основной процесс
+    """
+
+    root: Path
+    held: dict[str, int]
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+        self.held = {}
+
+    @staticmethod
+    def hash(data: bytes) -> str:
+        return hashlib.sha256(data).hexdigest()
+
+    def path(self, photo_hash: str) -> Path:
+        return self.root / photo_hash[:2] / photo_hash[2:4] / photo_hash
+
+    async def put(self, data: bytes, hold: bool = False) -> str:
+        """
+        Сохраняет фотографию, если такой ещё нет
+            С hold=True фотография удерживается от discard до release: удержание ставится раньше проверки
+            существования, так что файл, найденный на диске, уже не будет удалён
+        """
+        photo_hash = self.hash(data)
+        if hold:
+            self.held[photo_hash] = self.held.get(photo_hash, 0) + 1
+        path = self.path(photo_hash)
+        if await aiofiles.os.path.exists(path):
+            return photo_hash
+
+        await aiofiles.os.makedirs(path.parent, exist_ok=True)
+        # Пишем во временный файл и атомарно переименовываем, чтобы читатели не увидели недописанный файл
+        tmp_path = path.with_name(f"{photo_hash}.{uuid.uuid4().hex}.tmp")
+        async with aiofiles.open(tmp_path, "wb") as file:
+            await file.write(data)
+        await aiofiles.os.replace(tmp_path, path)
+        return photo_hash
+
+    async def read(self, photo_hash: str) -> bytes:
+        async with aiofiles.open(self.path(photo_hash), "rb") as file:
+            return await file.read()
+
+    @contextlib.contextmanager
+    def open(self, photo_hash: str) -> Iterator[memoryview]:
+        """Отображает файл в память, не копируя его содержимое в процесс"""
+        with open(self.path(photo_hash), "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                yield memoryview(b"")
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    yield view
+                finally:
+                    view.release()
+
+    def exists(self, photo_hash: str) -> bool:
+        return self.path(photo_hash).exists()
+
+    def release(self, photo_hashes: list[str]):
+        """Снимает удержание put(hold=True) после того, как ссылающиеся строки закоммичены (или не будут)"""
+        for photo_hash in photo_hashes:
+            count = self.held.get(photo_hash, 0) - 1
+            if count > 0:
+                self.held[photo_hash] = count
+            else:
+                self.held.pop(photo_hash, None)
+
+    def discard(self, photo_hashes: set[str]) -> set[str]:
+        """
+        Удаляет файлы фотографий, кроме удержанных, возвращает удалённые хеши
+            Вызывается из задания DatabaseWriter, когда ссылки на хеши в базе уже перепроверены. Удаление
+            синхронное: между проверкой удержания и unlink цикл событий не переключается на put
+        """
+        removed = set()
+        for photo_hash in photo_hashes:
+            if photo_hash in self.held:
+                continue
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(photo_hash))
+                removed.add(photo_hash)
+        return removed
@@ -0,0 +1,91 @@
+from sqlalchemy import String, Connection, text
+from sqlalchemy.orm import mapped_column, Mapped
+
+from database.base import Base
+
+ONLINE = "online"
+OFFLINE = "offline"
+
+
+class StatusCounter(Base):
+    """
+    Количество номеров в каждом статусе отдельно для онлайн и оффлайн режима
+        Поддерживается триггерами на numbers, поэтому статус читается без COUNT по всей таблице
+        и остаётся верным при записи из любого процесса
+    """
+
+    __tablename__ = "status_counters"
+
+    mode: Mapped[str] = mapped_column(String(7), primary_key=True)
+    status: Mapped[str] = mapped_column(String(11), primary_key=True)
+    count: Mapped[int] = mapped_column(default=0, server_default="0")
+
+
+class ThroughputBucket(Base):
+    """Сколько номеров перешло в COMPLETED/ERROR за минуту (minute - unix-время // 60), хранятся сутки"""
+
+    __tablename__ = "throughput_buckets"
+
+    minute: Mapped[int] = mapped_column(primary_key=True)
+    mode: Mapped[str] = mapped_column(String(7), primary_key=True)
+    handled: Mapped[int] = mapped_column(default=0, server_default="0")
+
+
+def mode_sql(row: str) -> str:
+    return f"CASE WHEN {row}.server_id IS NULL THEN '{OFFLINE}' ELSE '{ONLINE}' END"
+
+
+def increment_sql(row: str) -> str:
+    return (
+        f"INSERT INTO status_counters (mode, status, count) VALUES ({mode_sql(row)}, {row}.status, 1)"
+        " ON CONFLICT (mode, status) DO UPDATE SET count = count + 1;"
+    )
+
+
+def decrement_sql(row: str) -> str:
+    return (
+        f"UPDATE status_counters SET count = count - 1"
+        f" WHERE mode = {mode_sql(row)} AND status = {row}.status;"
+    )
+
+
+HANDLED = "('COMPLETED', 'ERROR')"
+CURRENT_MINUTE = "CAST(strftime('%s', 'now') AS INTEGER) / 60"
+BUCKETS_TTL_MINUTES = 24 * 60
+
+TRIGGERS = [
+    f"""CREATE TRIGGER IF NOT EXISTS numbers_counters_insert AFTER INSERT ON numbers
+    BEGIN {increment_sql("NEW")} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS numbers_counters_delete AFTER DELETE ON numbers
+    BEGIN {decrement_sql("OLD")} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS numbers_counters_update AFTER UPDATE OF status, server_id ON numbers
+    WHEN OLD.status IS NOT NEW.status OR (OLD.server_id IS NULL) IS NOT (NEW.server_id IS NULL)
+    BEGIN {decrement_sql("OLD")} {increment_sql("NEW")} END""",
+    f"""CREATE TRIGGER IF NOT EXISTS numbers_throughput AFTER UPDATE OF status ON numbers
+    WHEN NEW.status IN {HANDLED} AND OLD.status NOT IN {HANDLED}
+    BEGIN
+        INSERT INTO throughput_buckets (minute, mode, handled) VALUES ({CURRENT_MINUTE}, {mode_sql("NEW")}, 1)
+        ON CONFLICT (minute, mode) DO UPDATE SET handled = handled + 1;
+    END""",
+    # Новая корзина появляется раз в минуту - заодно выкидываем устаревшие
+    f"""CREATE TRIGGER IF NOT EXISTS throughput_buckets_expire AFTER INSERT ON throughput_buckets
+    BEGIN DELETE FROM throughput_buckets WHERE minute < NEW.minute - {BUCKETS_TTL_MINUTES}; END""",
+]
+
+
+def install_status_counters(conn: Connection, rebuild: bool = False):
+    """
+    Создаёт триггеры счётчиков. rebuild пересчитывает счётчики по таблице numbers целиком -
+    нужен один раз, когда счётчики появляются в базе, где номера уже есть
+    """
+    for trigger in TRIGGERS:
+        conn.execute(text(trigger))
+    if not rebuild:
+        return
+    conn.execute(text("DELETE FROM status_counters"))
+    conn.execute(
+        text(
+            f"INSERT INTO status_counters (mode, status, count)"
+            f" SELECT {mode_sql('numbers')}, status, count(1) FROM numbers GROUP BY 1, 2"
+        )
+    )
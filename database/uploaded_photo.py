@@ -0,0 +1,15 @@
+from datetime import datetime
+
+from sqlalchemy import String
+from sqlalchemy.orm import mapped_column, Mapped
+
+from database.base import Base
+
+
+class UploadedPhoto(Base):
+    """Локальный индекс фотографий, которые уже лежат в Object Store сервера (по хешу содержимого)"""
+
+    __tablename__ = "uploaded_photos"
+
+    image_hash: Mapped[str] = mapped_column(String(64), primary_key=True)
+    uploaded_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
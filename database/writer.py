@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, TypeVar
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+T = TypeVar("T")
+WriteJob = Callable[[AsyncSession], Awaitable[T]]
+
+
+class DatabaseWriter:
+    """
+    Единственный писатель в базу внутри процесса
+        Все изменения отправляются сюда через submit и выполняются одной задачей по очереди.
+        Накопившиеся за batch_delay задания пишутся одной транзакцией (BEGIN IMMEDIATE на стороне
+        движка), каждое в своём SAVEPOINT, так что ошибка одного задания не откатывает соседей.
+        Задание получает сессию и не должно само делать commit/rollback.
+        Между процессами (парсер и ZmqListenerService) запись разводит сама SQLite через busy_timeout
+    """
+
+    session_factory: sessionmaker
+    batch_size: int
+    batch_delay: float
+    logger: logging.Logger
+
+    queue: asyncio.Queue | None = None
+    task: asyncio.Task | None = None
+    loop: asyncio.AbstractEventLoop | None = None
+
+    def __init__(
+        self,
+        session_factory: sessionmaker,
+        batch_size: int = 100,
+        batch_delay: float = 0.0,
+        logger: logging.Logger = logging.getLogger("DatabaseWriter"),
+    ):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.logger = logger
+
+    def ensure_started(self):
+        loop = asyncio.get_running_loop()
+        # Очередь и задача привязаны к циклу событий: у дочернего процесса и у нового asyncio.run свои
+        if self.loop is loop and self.task is not None and not self.task.done():
+            return
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.task = loop.create_task(self.run())
+
+    async def submit(self, job: WriteJob[T]) -> T:
+        self.ensure_started()
+        future = self.loop.create_future()
+        await self.queue.put((job, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.batch_delay > 0 and self.queue.empty():
+                await asyncio.sleep(self.batch_delay)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.write(batch)
+            except Exception as e:
+                self.logger.error(f"Не удалось записать пачку из {len(batch)} заданий: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def write(self, batch: list[tuple[WriteJob, asyncio.Future]]):
+        outcomes = []
+        async with self.session_factory() as session:
+            async with session.begin():
+                for job, future in batch:
+                    if future.done():
+                        # Вызывающий уже отменил ожидание
+                        continue
+                    try:
+                        async with session.begin_nested():
+                            outcomes.append((future, await job(session), None))
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+        # Результаты отдаём только после коммита: вызывающий не должен увидеть незаписанные данные
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
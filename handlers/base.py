@@ -10,6 +10,8 @@ from nats.aio.msg import Msg
 class BaseHandler(ABC):
     subject: str
     logger: logging.Logger
+    # Обработчики, которые подтверждают сообщения сами (например, после пакетной записи), выключают это
+    auto_ack: bool = True
 
     def __init__(self, logger: logging.Logger, stream_name: str):
         self.logger = logger
@@ -26,7 +28,8 @@ class BaseHandler(ABC):
     async def handle_message(self, msg: Msg):
         try:
             await self.handle(msg)
-            await msg.ack()
+            if self.auto_ack:
+                await msg.ack()
         except ValidationError as e:
             self.logger.error(
                 f"Ошибка валидации при обработке сообщения: {len(msg.data)} - {e}"
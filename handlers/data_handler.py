@@ -1,14 +1,27 @@
+import asyncio
 import logging
 from typing import Callable, Awaitable
 
-import sqlalchemy.exc
+import nats.errors
 from nats.aio.client import Client
 from nats.aio.msg import Msg
+from nats.js import JetStreamContext
 from pydantic import BaseModel
 
 import utils
-from database import get_session, Number
+from config import settings
+from database import get_session, writer, insert_numbers, count_backlog
 from handlers.base import BaseHandler
+from metrics import registry
+
+
+PUSH = "push"
+PULL = "pull"
+
+# Метрики приёма: запись пачки и подтверждения, принятые номера (label result: inserted, duplicate)
+FLUSH_SECONDS = "ingest_flush_seconds"
+CONFIRM_SECONDS = "ingest_confirm_seconds"
+NUMBERS_TOTAL = "ingest_numbers_total"
 
 
 class NumberTask(BaseModel):
@@ -17,30 +30,140 @@ class NumberTask(BaseModel):
 
 
 class DataHandler(BaseHandler):
+    """
+    Приём номеров от сервера с групповой записью
+        Входящие задачи копятся до batch_size штук или batch_delay секунд, пишутся в базу одним
+        INSERT OR IGNORE в одной транзакции, и только после коммита на каждое сообщение пачки
+        отправляется ответ и ack.
+        В режиме pull задачи забираются из durable JetStream-консьюмера, и только пока локальная
+        очередь ниже high_water_mark. Несколько клиентов на одном консьюмере делят работу
+        пропорционально тому, как быстро они парсят, а задачи не теряются, пока клиент выключен
+    """
+
     stream_name: str = "data"
+    auto_ack: bool = False
+    mode: str
+    batch_size: int
+    batch_delay: float
+    pending: list[tuple[NumberTask, Msg]]
+    flush_timer: asyncio.Task | None = None
+    pull_task: asyncio.Task | None = None
 
     def __init__(self, logger: logging.Logger):
         super().__init__(logger, "data")
+        self.batch_size = settings.ingest.batch_size
+        self.batch_delay = settings.ingest.batch_delay
+        self.mode = settings.ingest.mode
+        self.pending = []
 
     async def subscribe(self, user_id: int, nc: Callable[[], Awaitable[Client]]):
+        if self.mode == PULL:
+            js: JetStreamContext = (await nc()).jetstream()
+            subscription = await js.pull_subscribe(
+                subject=self.subject + str(user_id),
+                durable=settings.ingest.durable.format(user_id),
+                stream=settings.ingest.stream,
+            )
+            if self.pull_task is not None:
+                self.pull_task.cancel()
+            self.pull_task = asyncio.create_task(self.pull(subscription))
+            return
+
         await (await nc()).subscribe(
             subject=self.subject + str(user_id), cb=self.handle_message
         )
 
+    async def pull(self, subscription: JetStreamContext.PullSubscription):
+        high_water_mark: int = settings.ingest.high_water_mark
+        while True:
+            try:
+                async with get_session() as session:
+                    backlog = await count_backlog(session)
+                free = high_water_mark - backlog - len(self.pending)
+                if free <= 0:
+                    self.logger.debug(f"Локальная очередь заполнена ({backlog}), жду")
+                    await asyncio.sleep(settings.ingest.poll_interval)
+                    continue
+
+                messages = await subscription.fetch(
+                    min(free, settings.ingest.fetch_batch),
+                    timeout=settings.ingest.fetch_timeout,
+                )
+            except nats.errors.TimeoutError:
+                continue
+            except Exception as e:
+                self.logger.error(f"Ошибка при получении задач: {e}")
+                await asyncio.sleep(settings.ingest.poll_interval)
+                continue
+
+            for msg in messages:
+                await self.handle_message(msg)
+            await self.flush()
+
     async def handle(self, msg: Msg):
         task: NumberTask | None = utils.unpack_msg(msg, NumberTask)
         if task is None:
             self.logger.error(f"Пустое сообщение: {msg}")
+            if self.mode == PULL:
+                # Иначе JetStream будет передоставлять битое сообщение бесконечно
+                await msg.term()
             return
 
         self.logger.debug(f"Получен новый номер: {task.number}")
+        self.pending.append((task, msg))
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = asyncio.create_task(self.flush_later())
 
-        async with get_session() as session:
-            try:
-                numbers = Number(server_id=task.id, number=task.number)
-                session.add(numbers)
-                await session.commit()
-                await msg.respond(utils.pack_msg(task))
-            except sqlalchemy.exc.IntegrityError as e:
-                self.logger.debug(e)
-        self.logger.debug(f"Сохранен {numbers} номер")
+    async def flush_later(self):
+        await asyncio.sleep(self.batch_delay)
+        self.flush_timer = None
+        await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if len(batch) == 0:
+            return
+
+        try:
+            with registry.timer(FLUSH_SECONDS):
+                inserted = await writer.submit(
+                    lambda session: insert_numbers(
+                        session, [{"server_id": task.id, "number": task.number} for task, _ in batch]
+                    )
+                )
+        except Exception as e:
+            self.logger.error(f"Не удалось сохранить пачку из {len(batch)} номеров: {e}")
+            registry.inc(NUMBERS_TOTAL, len(batch), result="failed")
+            await self.reject(batch)
+            return
+        registry.inc(NUMBERS_TOTAL, inserted, result="inserted")
+        registry.inc(NUMBERS_TOTAL, len(batch) - inserted, result="duplicate")
+        self.logger.debug(
+            f"Сохранено {inserted} номеров, дубликатов {len(batch) - inserted}"
+        )
+
+        with registry.timer(CONFIRM_SECONDS):
+            results = await asyncio.gather(
+                *[self.confirm(task, msg) for task, msg in batch], return_exceptions=True
+            )
+        for error in (e for e in results if isinstance(e, Exception)):
+            self.logger.error(f"Ошибка при подтверждении номера: {error}")
+
+    async def reject(self, batch: list[tuple[NumberTask, Msg]]):
+        """
+        Пачка не записана: в pull режиме сразу возвращаем сообщения JetStream (nak), чтобы их передоставили
+        без ожидания ack_wait. В push режиме сервер сам повторит запрос, не дождавшись ответа
+        """
+        if self.mode != PULL:
+            return
+        results = await asyncio.gather(*[msg.nak() for _, msg in batch], return_exceptions=True)
+        for error in (e for e in results if isinstance(e, Exception)):
+            self.logger.error(f"Ошибка при возврате номера: {error}")
+
+    async def confirm(self, task: NumberTask, msg: Msg):
+        # В pull режиме reply - это служебный subject подтверждения JetStream, отвечать туда нельзя
+        if self.mode == PUSH:
+            await msg.respond(utils.pack_msg(task))
+        await msg.ack()
@@ -0,0 +1,172 @@
+import contextlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Iterator
+
+# Границы корзин гистограмм в секундах: от миллисекунд (запись в базу) до полных загрузок WhatsApp
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def metric_key(name: str, labels: dict[str, str]) -> str:
+    """Ключ метрики в формате Prometheus: name{label="value",...}"""
+    if len(labels) == 0:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in sorted(labels.items())) + "}"
+
+
+class Histogram:
+    buckets: tuple[float, ...]
+    counts: list[int]
+    sum: float = 0
+    count: int = 0
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def snapshot(self) -> dict:
+        # Корзины накопительные, как в Prometheus; значения больше последней границы видны только в count
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {"buckets": buckets, "sum": self.sum, "count": self.count}
+
+
+class MetricsRegistry:
+    """
+    Счётчики и гистограммы длительностей этапов в памяти процесса
+        Метрики без блокировок: всё пишется из одного цикла событий.
+        Процесс, у которого нет сокета управления, выгружает snapshot() в файл (см. MetricsService),
+        а слушатель zmq сливает его со своими метриками командой metrics
+    """
+
+    counters: dict[str, float]
+    histograms: dict[str, Histogram]
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        key = metric_key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, **labels: str):
+        key = metric_key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """Замеряет блок (в том числе с await внутри), неудачные попытки тоже попадают в гистограмму"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+
+    def snapshot(self) -> dict:
+        return {
+            "updated": time.time(),
+            "counters": dict(self.counters),
+            "histograms": {key: histogram.snapshot() for key, histogram in self.histograms.items()},
+        }
+
+
+registry = MetricsRegistry()
+
+
+def merge(*snapshots: dict) -> dict:
+    """Сводит снимки нескольких процессов в один, одноимённые метрики складываются"""
+    counters: dict[str, float] = {}
+    histograms: dict[str, dict] = {}
+    for snapshot in snapshots:
+        for key, value in snapshot.get("counters", {}).items():
+            counters[key] = counters.get(key, 0) + value
+        for key, histogram in snapshot.get("histograms", {}).items():
+            known = histograms.get(key)
+            if known is None:
+                histograms[key] = {
+                    "buckets": [list(bucket) for bucket in histogram["buckets"]],
+                    "sum": histogram["sum"],
+                    "count": histogram["count"],
+                }
+                continue
+            for bucket, (_, count) in zip(known["buckets"], histogram["buckets"]):
+                bucket[1] += count
+            known["sum"] += histogram["sum"]
+            known["count"] += histogram["count"]
+    return {"counters": counters, "histograms": histograms}
+
+
+def quantile(histogram: dict, q: float) -> float | None:
+    """Оценка квантиля по корзинам: верхняя граница первой корзины, где набралась доля q"""
+    if histogram["count"] == 0:
+        return None
+    rank = q * histogram["count"]
+    for bound, cumulative in histogram["buckets"]:
+        if cumulative >= rank:
+            return bound
+    return float("inf")
+
+
+def prometheus_text(snapshot: dict) -> str:
+    """Снимок в текстовом формате экспозиции Prometheus"""
+    lines = []
+    typed: set[str] = set()
+
+    def split(key: str) -> tuple[str, str]:
+        name, _, labels = key.partition("{")
+        return name, labels.rstrip("}")
+
+    for key, value in sorted(snapshot.get("counters", {}).items()):
+        name, _ = split(key)
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{key} {value}")
+    for key, histogram in sorted(snapshot.get("histograms", {}).items()):
+        name, labels = split(key)
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        prefix = labels + "," if labels else ""
+        for bound, cumulative in histogram["buckets"]:
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram["count"]}')
+        suffix = "{" + labels + "}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {histogram['sum']}")
+        lines.append(f"{name}_count{suffix} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_atomic(path: Path, content: str):
+    """Читатель в другом процессе не должен увидеть наполовину записанный файл"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(path.name + ".tmp")
+    temporary.write_text(content)
+    os.replace(temporary, path)
+
+
+def read_snapshot(path: Path) -> dict | None:
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None
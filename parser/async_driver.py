@@ -0,0 +1,76 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from selenium import webdriver
+from selenium.common import TimeoutException
+
+T = TypeVar("T")
+
+
+class AsyncDriver:
+    """
+    Асинхронный фасад над webdriver.Chrome
+        Все команды браузера выполняются в одном выделенном потоке, поэтому цикл событий
+        (хартбиты, приём номеров, отправка результатов) не простаивает, пока WhatsApp грузится.
+        Один поток заодно гарантирует, что команды разных вкладок не перемешаются
+    """
+
+    driver: webdriver.Chrome
+    executor: ThreadPoolExecutor
+    call_timeout: float | None
+    logger: logging.Logger = logging.getLogger("AsyncDriver")
+
+    def __init__(
+        self,
+        driver: webdriver.Chrome,
+        executor: ThreadPoolExecutor,
+        call_timeout: float | None = None,
+    ):
+        self.driver = driver
+        self.executor = executor
+        self.call_timeout = call_timeout
+
+    @staticmethod
+    async def start(
+        factory: Callable[[], webdriver.Chrome], call_timeout: float | None = None
+    ) -> "AsyncDriver":
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="webdriver")
+        try:
+            driver = await asyncio.get_running_loop().run_in_executor(executor, factory)
+        except Exception:
+            executor.shutdown(wait=False)
+            raise
+        return AsyncDriver(driver, executor, call_timeout)
+
+    async def run(
+        self, fn: Callable[..., T], *args, timeout: float | None = None
+    ) -> T:
+        """
+        Выполняет fn(*args) в потоке браузера
+            Если команда не уложилась в timeout (по умолчанию call_timeout), ожидание прерывается
+            с TimeoutException. Сам зависший вызов обрывается таймаутом соединения с chromedriver
+            либо вызовом quit()
+        """
+        timeout = timeout if timeout is not None else self.call_timeout
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(fn, *args)
+        )
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutException(f"Браузер не ответил за {timeout} с")
+
+    async def call(self, fn: Callable[[webdriver.Chrome], T], **kwargs) -> T:
+        return await self.run(fn, self.driver, **kwargs)
+
+    async def quit(self):
+        # quit выполняется вне потока браузера: если там висит команда, остановка chromedriver её оборвёт
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.driver.quit)
+        except Exception as e:
+            self.logger.error(e)
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
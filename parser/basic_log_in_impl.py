@@ -2,32 +2,68 @@ import base64
 import logging
 from pathlib import Path
 
-from selenium import webdriver
 from selenium.common import TimeoutException
 from selenium.webdriver.common.by import By
+from selenium.webdriver.remote.webelement import WebElement
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 
+from parser.async_driver import AsyncDriver
 from parser.xpaths import user_header_xpath, qr_code_xpath
 
 logger = logging.getLogger(__name__)
 
 
 class BasicLogInImpl:
-    def __init__(self, driver: webdriver.Chrome):
+    def __init__(self, driver: AsyncDriver, url: str = "https://web.whatsapp.com"):
         self.driver = driver
+        self.url = url
 
-    def log_in(self, timeout: int, screenshot_filename: Path) -> bool:
-        self.driver.get("https://web.whatsapp.com")
+    async def open(self, timeout: int) -> WebElement | None:
+        """
+        Открывает WhatsApp и ждёт либо список чатов, либо QR-код. None - профиль уже авторизован,
+        иначе элемент с QR-кодом
+        """
+        await self.driver.call(lambda driver: driver.get(self.url))
+        # Ожидания целиком уходят в поток браузера, поэтому свой таймаут фасада им не нужен
+        found = await self.driver.call(
+            lambda driver: WebDriverWait(driver, timeout).until(
+                EC.any_of(
+                    EC.presence_of_element_located((By.XPATH, user_header_xpath)),
+                    EC.presence_of_element_located((By.XPATH, qr_code_xpath)),
+                )
+            ),
+            timeout=timeout + 1,
+        )
+        if await self.driver.call(lambda driver: driver.find_elements(By.XPATH, user_header_xpath)):
+            return None
+        return found
+
+    async def is_logged_in(self, timeout: int) -> bool:
+        """Проверка сессии без ожидания сканирования QR-кода"""
+        try:
+            return await self.open(timeout) is None
+        except TimeoutException:
+            return False
+
+    async def log_in(self, timeout: int, screenshot_filename: Path) -> bool:
         try:
-            qr_code = WebDriverWait(self.driver, timeout).until(
-                EC.presence_of_element_located((By.XPATH, qr_code_xpath))
+            # Профиль может быть уже авторизован - тогда QR-кода не будет
+            qr_code = await self.open(timeout)
+            if qr_code is None:
+                logger.info("Пользователь уже авторизован")
+                return True
+            canvas_base64 = await self.driver.call(
+                lambda driver: driver.execute_script(
+                    "return arguments[0].toDataURL('image/png').substring(21);", qr_code
+                )
             )
-            canvas_base64 = self.driver.execute_script("return arguments[0].toDataURL('image/png').substring(21);",
-                                                       qr_code)
             screenshot_filename.write_bytes(base64.b64decode(canvas_base64))
-            WebDriverWait(self.driver, timeout).until(
-                EC.presence_of_element_located((By.XPATH, user_header_xpath))
+            await self.driver.call(
+                lambda driver: WebDriverWait(driver, timeout).until(
+                    EC.presence_of_element_located((By.XPATH, user_header_xpath))
+                ),
+                timeout=timeout + 1,
             )
             logger.info("Успешный вход")
             return True
@@ -1,16 +1,22 @@
+import asyncio
+import base64
 import logging
-from io import BytesIO
-from pathlib import Path
+import time
+import urllib.request
+from typing import Callable, TypeVar
 
-from PIL import Image
 from selenium.webdriver import Chrome
-from selenium.common import TimeoutException, NoSuchElementException
-from selenium.webdriver.common.by import By
+from selenium.common import (
+    TimeoutException,
+    NoSuchElementException,
+    StaleElementReferenceException,
+)
 from selenium.webdriver.remote.webelement import WebElement
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.wait import WebDriverWait
 
-from database import Number, NumberStatus
+from database import Number, NumberStatus, PhotoStore
+from metrics import registry
+from parser.async_driver import AsyncDriver
+from parser.image_processor import ImageProcessor, image_extension
 from parser.xpaths import (
     error_button_xpath,
     on_profile_second_xpath,
@@ -18,80 +24,356 @@ from parser.xpaths import (
     photo_xpath, profile_button_xpath,
 )
 
+T = TypeVar("T")
+
+ERROR_STATE = "error"
+CHAT_STATE = "chat"
+PROFILE_STATE = "profile"
+BUSINESS_STATE = "business"
+PHOTO_STATE = "photo"
+
+RELOAD = "reload"
+IN_APP = "in_app"
+FALLBACK = "fallback"
+
+STALE_ATTRIBUTE = "data-parser-stale"
+
+
+def fresh(xpath: str) -> str:
+    """xpath без элементов, помеченных устаревшими при переходе внутри приложения"""
+    return f"{xpath}[not(@{STALE_ATTRIBUTE})]"
+
+
+SCREENSHOT = "screenshot"
+SOURCE = "source"
+
+# Метрики: длительность этапов парсинга номера (label stage), номера целиком и их итог (label result)
+STAGE_SECONDS = "parser_stage_seconds"
+NUMBER_SECONDS = "parser_number_seconds"
+NUMBERS_TOTAL = "parser_numbers_total"
+
+# arguments[0] - список пар [состояние, xpath]. Возвращает [состояние, элемент] для первого видимого элемента
+FIND_FIRST_VISIBLE_SCRIPT = """
+for (const [state, xpath] of arguments[0]) {
+    const element = document.evaluate(
+        xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+    ).singleNodeValue;
+    if (element !== null && element.getClientRects().length > 0) {
+        return [state, element];
+    }
+}
+return null;
+"""
+
+# Открывает чат внутри уже загруженного приложения: кликает по невидимой ссылке на номер, как по ссылке
+# из сообщения. Перед этим закрывает диалог ошибки и шторку профиля (Escape) и помечает все элементы
+# предыдущего чата - шапку, шторку и аватарку, - чтобы ожидания не приняли их за элементы нового.
+# Если приложение ссылку не перехватило, обработчик на window отменяет переход, и вкладка остаётся на месте
+IN_APP_NAVIGATION_SCRIPT = """
+const [href, dismissXpath, staleXpaths, staleAttribute] = arguments;
+const dialog = document.evaluate(
+    dismissXpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+).singleNodeValue;
+if (dialog !== null) {
+    dialog.click();
+}
+document.dispatchEvent(new KeyboardEvent("keydown", {key: "Escape", keyCode: 27, bubbles: true}));
+for (const xpath of staleXpaths) {
+    const found = document.evaluate(
+        xpath, document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null
+    );
+    for (let index = 0; index < found.snapshotLength; index++) {
+        found.snapshotItem(index).setAttribute(staleAttribute, "1");
+    }
+}
+const guard = (event) => event.preventDefault();
+window.addEventListener("click", guard);
+const anchor = document.createElement("a");
+anchor.href = href;
+anchor.style.display = "none";
+(document.getElementById("app") || document.body).appendChild(anchor);
+anchor.click();
+anchor.remove();
+window.removeEventListener("click", guard);
+"""
+
+
+def download(url: str, timeout: float) -> bytes:
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return response.read()
+
 
 class BasicParserImpl:
     url: str
-    webdriver: Chrome
+    webdriver: AsyncDriver
+    image_processor: ImageProcessor
+    window_handle: str | None
     wait_timeout: int
+    poll_interval: float
     logger: logging.Logger
-    photos_dir: Path
+    photo_store: PhotoStore
+    navigation: str
+    in_app_url: str
+    in_app_timeout: float
+    max_in_app_failures: int
+    # Приложение WhatsApp загружено во вкладке и в нём можно переходить между чатами без перезагрузки
+    app_loaded: bool = False
+    in_app_failures: int = 0
+    navigation_stats: dict[str, int]
+    photo_capture: str
+    source_timeout: float
+    # Перекодировать и исходник аватарки по settings.parser.image, а не только скриншот
+    transcode_source: bool
+    capture_stats: dict[str, int]
+    page_loads: int = 0
+    page_load_seconds: float = 0
 
     def __init__(
         self,
-        driver: Chrome,
+        driver: AsyncDriver,
         url: str,
         webdriver_timeout: int,
-        photos_dir: str,
+        photo_store: PhotoStore,
+        image_processor: ImageProcessor,
         logger: logging.Logger = logging.getLogger("Parser"),
+        window_handle: str | None = None,
+        poll_interval: float = 0.25,
+        navigation: str = RELOAD,
+        in_app_url: str = "https://wa.me/{0}",
+        in_app_timeout: float = 3,
+        max_in_app_failures: int = 5,
+        photo_capture: str = SCREENSHOT,
+        source_timeout: float = 3,
+        transcode_source: bool = False,
     ):
         super(BasicParserImpl, self).__init__()
         self.url = url
         self.wait_timeout = webdriver_timeout
+        self.poll_interval = poll_interval
         self.logger = logger
-        self.photos_dir = Path(photos_dir)
+        self.photo_store = photo_store
         self.webdriver = driver
+        self.image_processor = image_processor
+        self.window_handle = window_handle
+        self.navigation = navigation
+        self.in_app_url = in_app_url
+        self.in_app_timeout = in_app_timeout
+        self.max_in_app_failures = max_in_app_failures
+        self.navigation_stats = {RELOAD: 0, IN_APP: 0, FALLBACK: 0}
+        self.photo_capture = photo_capture
+        self.source_timeout = source_timeout
+        self.transcode_source = transcode_source
+        self.capture_stats = {SOURCE: 0, SCREENSHOT: 0}
 
-    async def save_photo(self, element: WebElement, number: Number):
-        image = Image.open(BytesIO(element.screenshot_as_png))
+    async def _call(self, fn: Callable[[Chrome], T]) -> T:
+        """
+        Выполняет fn в потоке браузера, предварительно переключившись на свою вкладку
+            Несколько вкладок делят один chromedriver, а переключение и команда выполняются
+            одной задачей в потоке браузера, так что другие вкладки не вклинятся
+            (в режиме одной вкладки handle не задан)
+        """
+
+        def switch_and_call(driver: Chrome) -> T:
+            if self.window_handle is not None:
+                driver.switch_to.window(self.window_handle)
+            return fn(driver)
+
+        return await self.webdriver.call(switch_and_call)
+
+    async def _wait(self, condition: Callable[[Chrome], T], timeout: float | None = None) -> T:
+        """
+        Аналог WebDriverWait.until, который между попытками отдаёт управление циклу,
+        чтобы остальные вкладки продолжали работу, пока эта ждёт отрисовки
+        """
+        deadline = time.monotonic() + (timeout if timeout is not None else self.wait_timeout)
+        while True:
+            try:
+                result = await self._call(condition)
+                if result:
+                    return result
+            except (NoSuchElementException, StaleElementReferenceException):
+                pass
+            if time.monotonic() >= deadline:
+                raise TimeoutException()
+            await asyncio.sleep(self.poll_interval)
+
+    async def _wait_any(
+        self, states: dict[str, str], timeout: float | None = None
+    ) -> tuple[str, WebElement]:
+        """
+        Ждёт первое из нескольких состояний страницы, заданных xpath'ами (порядок - приоритет)
+            Все xpath проверяются одним скриптом за опрос, а не отдельной командой WebDriver на каждый.
+            MutationObserver внутри execute_async_script держал бы поток браузера до конца ожидания
+            и останавливал остальные вкладки, поэтому опрашиваем с отдачей управления между попытками
+        """
+        found = await self._wait(
+            lambda driver: driver.execute_script(FIND_FIRST_VISIBLE_SCRIPT, list(states.items())),
+            timeout,
+        )
+        return found[0], found[1]
 
-        # image = Image.open(self.photos_dir / (number.number + ".png"))
-        image_bytes = BytesIO()
-        image.resize((image.size[0] // 2, image.size[1] // 2), Image.ANTIALIAS).save(
-            image_bytes, "PNG", optimise=True, quality=50
+    async def open_chat(self, number: Number) -> tuple[str, WebElement]:
+        """
+        Открывает чат номера и ждёт, чем закончится: диалогом ошибки или шапкой чата
+            В режиме in_app, если приложение уже загружено, чат открывается без перезагрузки страницы.
+            Если за in_app_timeout новое состояние не появилось, делается полный get. После
+            max_in_app_failures таких откатов подряд вкладка переходит на полные перезагрузки
+        """
+        terminal_states = {ERROR_STATE: error_button_xpath, CHAT_STATE: profile_button_xpath}
+        if self.navigation == IN_APP and self.app_loaded:
+            started = time.perf_counter()
+            await self._call(
+                lambda driver: driver.execute_script(
+                    IN_APP_NAVIGATION_SCRIPT,
+                    self.in_app_url.format(number.number),
+                    error_button_xpath,
+                    [
+                        *terminal_states.values(),
+                        on_profile_second_xpath,
+                        business_photo_xpath,
+                        photo_xpath,
+                    ],
+                    STALE_ATTRIBUTE,
+                )
+            )
+            try:
+                # Старая шапка помечена, поэтому совпасть может только отрисованная заново
+                found = await self._wait_any(
+                    {state: fresh(xpath) for state, xpath in terminal_states.items()},
+                    self.in_app_timeout,
+                )
+                self.navigation_stats[IN_APP] += 1
+                self.in_app_failures = 0
+                registry.observe(STAGE_SECONDS, time.perf_counter() - started, stage=IN_APP)
+                return found
+            except TimeoutException:
+                registry.observe(STAGE_SECONDS, time.perf_counter() - started, stage=FALLBACK)
+                self.navigation_stats[FALLBACK] += 1
+                self.in_app_failures += 1
+                if self.in_app_failures >= self.max_in_app_failures:
+                    self.logger.warning(
+                        "Переход внутри приложения не срабатывает, вкладка переходит на полную загрузку"
+                    )
+                    self.navigation = RELOAD
+        else:
+            self.navigation_stats[RELOAD] += 1
+
+        self.app_loaded = False
+        started = time.monotonic()
+        with registry.timer(STAGE_SECONDS, stage="get"):
+            await self._call(lambda driver: driver.get(self.url.format(number.number)))
+        self.page_loads += 1
+        self.page_load_seconds += time.monotonic() - started
+        with registry.timer(STAGE_SECONDS, stage="chat_wait"):
+            found = await self._wait_any(terminal_states)
+        self.app_loaded = True
+        return found
+
+    async def fetch_source(self, element: WebElement) -> bytes | None:
+        """
+        Исходный файл аватарки по src элемента, без скриншота
+            Из браузера берётся только адрес (одна быстрая команда), а сам файл качается в отдельном потоке
+            с таймаутом source_timeout, так что поток браузера и остальные вкладки не ждут загрузки.
+            None, если адреса нет, это blob:, или загрузка не удалась - тогда фотографию снимаем скриншотом
+        """
+        source = await self._call(
+            lambda driver: driver.execute_script(
+                "return arguments[0].currentSrc || arguments[0].src || null;", element
+            )
         )
+        if not source:
+            return None
+        if source.startswith("data:"):
+            image = base64.b64decode(source.split(",", 1)[1]) if "," in source else b""
+        elif source.startswith(("http://", "https://")):
+            try:
+                image = await asyncio.to_thread(download, source, self.source_timeout)
+            except Exception as e:
+                self.logger.debug(f"Не удалось скачать аватарку: {e}")
+                return None
+        else:
+            return None
+        # Вместо картинки может прийти заглушка или html ошибки
+        return image if image_extension(image) != "bin" else None
 
-        number.image = image_bytes.getvalue()
-        self.logger.info(f"Фотография {number.number}.png сохранена")
+    async def save_photo(self, element: WebElement, number: Number):
+        image = None
+        if self.photo_capture == SOURCE:
+            with registry.timer(STAGE_SECONDS, stage="fetch_source"):
+                image = await self.fetch_source(element)
+        if image is not None:
+            self.capture_stats[SOURCE] += 1
+            # Исходник сохраняется как есть (формат проверен в fetch_source): ради оригинальных байтов
+            # его и качаем, и пул процессов на него не тратится
+            transcode = self.transcode_source
+        else:
+            with registry.timer(STAGE_SECONDS, stage="screenshot"):
+                image = await self._call(lambda _: element.screenshot_as_png)
+            self.capture_stats[SCREENSHOT] += 1
+            transcode = True
+        if transcode:
+            with registry.timer(STAGE_SECONDS, stage="process_image"):
+                image = await self.image_processor.process(image)
+        with registry.timer(STAGE_SECONDS, stage="store_photo"):
+            # Удержание снимает Parser после записи результатов в базу
+            number.image_hash = await self.photo_store.put(image, hold=True)
+        self.logger.info(
+            f"Фотография {number.number}.{image_extension(image)} сохранена"
+        )
 
-    async def parse(self, number: Number) -> None:
+    async def parse(self, number: Number) -> Exception | None:
         """
         1. Parse number
         2. Set status of the parsing accordingly to the rule:
             Parsing status: 0 - not started, 1 - parsing, 2 - finished, 3 - error. Secondcheck falls to its own status
+            The number comes already claimed (IN_PROGRESS), so a failed first attempt goes to secondcheck
+            and a failed repeated attempt goes to error
+        3. Return the exception of a failed attempt (None on success) for the rate scheduler
         """
+        started = time.perf_counter()
         try:
-            self.webdriver.get(self.url.format(number.number))
-            try:
-                WebDriverWait(self.webdriver, self.wait_timeout).until(
-                    EC.element_to_be_clickable((By.XPATH, error_button_xpath))
-                )
+            # Диалог "номер не зарегистрирован" и шапка чата гонятся друг с другом, так что валидный номер
+            # больше не ждёт полный таймаут на поиск диалога ошибки
+            state, element = await self.open_chat(number)
+            if state == ERROR_STATE:
                 number.status = NumberStatus.ERROR
-            except TimeoutException:
-                profile_button = WebDriverWait(self.webdriver, self.wait_timeout).until(
-                    EC.element_to_be_clickable((By.XPATH, profile_button_xpath))
-                )
-                profile_button.click()
-
-                try:
-                    second_profile_button = self.webdriver.find_element(
-                        By.XPATH, on_profile_second_xpath
-                    )
-                    second_profile_button.click()
-                except NoSuchElementException:
-                    second_profile_button = self.webdriver.find_element(
-                        By.XPATH, business_photo_xpath
+            else:
+                with registry.timer(STAGE_SECONDS, stage="header_click"):
+                    await self._call(lambda _: element.click())
+                # Шторка профиля обычного и бизнес-аккаунта отличаются, ждём ту, что появится.
+                # Шторка и аватарка предыдущего чата при переходе внутри приложения помечены устаревшими
+                with registry.timer(STAGE_SECONDS, stage="profile_wait"):
+                    _, element = await self._wait_any(
+                        {
+                            PROFILE_STATE: fresh(on_profile_second_xpath),
+                            BUSINESS_STATE: fresh(business_photo_xpath),
+                        }
                     )
-                    second_profile_button.click()
+                with registry.timer(STAGE_SECONDS, stage="profile_click"):
+                    await self._call(lambda _: element.click())
 
-                photo = WebDriverWait(self.webdriver, self.wait_timeout).until(
-                    EC.element_to_be_clickable((By.XPATH, photo_xpath))
-                )
-                await self.save_photo(photo, number)
+                with registry.timer(STAGE_SECONDS, stage="photo_wait"):
+                    _, photo = await self._wait_any({PHOTO_STATE: fresh(photo_xpath)})
+                with registry.timer(STAGE_SECONDS, stage="save_photo"):
+                    await self.save_photo(photo, number)
                 number.status = NumberStatus.COMPLETED
 
         except Exception as e:
             self.logger.error(f"Parsing error: {e}")
-            if number.status == NumberStatus.SECONDCHECK:
+            # Вкладка могла остаться в непонятном состоянии, следующий номер откроем полной загрузкой
+            self.app_loaded = False
+            number.attempts += 1
+            if number.attempts > 1:
                 number.status = NumberStatus.ERROR
             else:
                 number.status = NumberStatus.SECONDCHECK
+            registry.inc(NUMBERS_TOTAL, result="failed")
+            return e
+        finally:
+            registry.observe(NUMBER_SECONDS, time.perf_counter() - started)
+        # Диалог "номер не зарегистрирован" - тоже успешный парсинг, но без фотографии
+        registry.inc(
+            NUMBERS_TOTAL,
+            result="completed" if number.status == NumberStatus.COMPLETED else "not_registered",
+        )
+        return None
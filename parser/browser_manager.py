@@ -0,0 +1,326 @@
+import asyncio
+import contextlib
+import logging
+import shutil
+import time
+from pathlib import Path
+from sys import platform
+
+from selenium import webdriver
+from selenium.common import WebDriverException
+from selenium.webdriver.remote.remote_connection import RemoteConnection
+
+from parser.async_driver import AsyncDriver
+from parser.browser_profile import chrome_options, block_urls, process_tree_rss
+
+# Кеши и блокировки профиля не переносим: первые только раздувают копию, вторые не дадут Chrome стартовать
+PROFILE_COPY_IGNORE = shutil.ignore_patterns(
+    "Cache", "Code Cache", "GPUCache", "ShaderCache", "GrShaderCache", "Singleton*", "lockfile"
+)
+PROFILE_SLOTS = ("user", "standby")
+# Где WhatsApp хранит сессию: если эти файлы менялись во время копирования, копия считается порванной
+SESSION_DIRS = ("IndexedDB", "Local Storage", "Session Storage")
+COPY_ATTEMPTS = 3
+
+
+class Browser:
+    """Запущенный Chrome: драйвер, вкладки (None - единственная текущая) и каталог профиля"""
+
+    driver: AsyncDriver
+    handles: list[str | None]
+    profile_dir: Path
+    # Запущен на копии профиля (резервный): сессию WhatsApp в нём нужно проверить при подхвате
+    copied: bool
+    started: float
+    parsed: int = 0
+
+    def __init__(
+        self, driver: AsyncDriver, handles: list[str | None], profile_dir: Path, copied: bool = False
+    ):
+        self.driver = driver
+        self.handles = handles
+        self.profile_dir = profile_dir
+        self.copied = copied
+        self.started = time.monotonic()
+
+    def rss(self) -> int | None:
+        service = getattr(self.driver.driver, "service", None)
+        if service is None or service.process is None:
+            return None
+        return process_tree_rss(service.process.pid)
+
+
+class BrowserManager:
+    """
+    Жизненный цикл браузеров парсера
+        Пока активный браузер работает, рядом может быть запущен тёплый резервный (use_standby, по умолчанию
+        выключен) - на копии профиля, с открытыми вкладками, но без WhatsApp: два окна на одной сессии
+        выбивали бы друг друга. Копия снимается с работающего Chrome, поэтому она проверяется: если файлы
+        сессии менялись во время копирования, копирование повторяется, а резервный старше standby_max_age
+        пересоздаётся, чтобы сессия в нём не устаревала. При перезапуске (падение или плановая замена после
+        recycle_after номеров или recycle_rss_mb памяти) старый браузер закрывается, и работу подхватывает
+        резервный. Если сессия в копии всё же не поднялась, fallback запускает Chrome на исходном профиле,
+        который к этому моменту закрыт и цел.
+        Профили живут в двух каталогах внутри chromedriver_data_dir и меняются ролями при каждой замене
+    """
+
+    chromedriver_path: Path
+    data_dir: Path
+    headless_mode: str | None
+    profile: str
+    blocked_urls: list[str]
+    tabs: int
+    command_timeout: float | None
+    use_standby: bool
+    standby_max_age: float
+    recycle_after: int
+    recycle_rss: int
+    rss_check_interval: float
+    probe_timeout: float
+    logger: logging.Logger
+
+    active: Browser | None = None
+    standby: Browser | None = None
+    standby_task: asyncio.Task | None = None
+    # Профиль последнего закрытого активного браузера: с него снималась копия для резервного
+    retired_profile: Path | None = None
+    rss_checked: float = 0
+
+    def __init__(
+        self,
+        chromedriver_path: Path,
+        data_dir: Path,
+        headless_mode: str | None,
+        profile: str,
+        blocked_urls: list[str],
+        tabs: int,
+        command_timeout: float | None,
+        use_standby: bool,
+        recycle_after: int,
+        recycle_rss_mb: int,
+        probe_timeout: float,
+        standby_max_age: float = 900,
+        rss_check_interval: float = 30,
+        logger: logging.Logger = logging.getLogger("BrowserManager"),
+    ):
+        self.chromedriver_path = chromedriver_path
+        self.data_dir = data_dir
+        self.headless_mode = headless_mode
+        self.profile = profile
+        self.blocked_urls = blocked_urls
+        self.tabs = tabs
+        self.command_timeout = command_timeout
+        self.use_standby = use_standby
+        self.standby_max_age = standby_max_age
+        self.recycle_after = recycle_after
+        self.recycle_rss = recycle_rss_mb * 2**20
+        self.probe_timeout = probe_timeout
+        self.rss_check_interval = rss_check_interval
+        self.logger = logger
+
+    def executable_path(self) -> str:
+        path = str(self.chromedriver_path)
+        if platform == "win32" and ".exe" not in path:
+            return path + ".exe"
+        return path
+
+    async def launch(self, profile_dir: Path, copied: bool = False) -> Browser:
+        options = chrome_options(profile_dir, self.headless_mode, self.profile)
+        if self.command_timeout is not None:
+            # Таймаут HTTP-соединения с chromedriver: обрывает зависшие команды в потоке браузера
+            RemoteConnection.set_timeout(self.command_timeout)
+        try:
+            driver = await AsyncDriver.start(
+                lambda: webdriver.Chrome(executable_path=self.executable_path(), options=options),
+                self.command_timeout,
+            )
+        except WebDriverException as e:
+            self.logger.error(e)
+            raise RuntimeError("Не удалось запустить chromedriver")
+        try:
+            handles = await driver.call(self.open_tabs)
+        except Exception:
+            await driver.quit()
+            raise
+        return Browser(driver, handles, profile_dir, copied)
+
+    def open_tabs(self, driver: webdriver.Chrome) -> list[str | None]:
+        block_urls(driver, self.blocked_urls)
+        if self.tabs <= 1:
+            return [None]
+        handles = [driver.current_window_handle]
+        for _ in range(self.tabs - 1):
+            driver.switch_to.new_window("tab")
+            block_urls(driver, self.blocked_urls)
+            handles.append(driver.current_window_handle)
+        driver.switch_to.window(handles[0])
+        return handles
+
+    def latest_profile(self) -> Path:
+        """Профиль, с которым работали последним: у закрытого Chrome "Local State" записан позже всех"""
+        if self.retired_profile is not None:
+            return self.retired_profile
+        profiles = [self.data_dir / slot for slot in PROFILE_SLOTS]
+        existing = [profile for profile in profiles if (profile / "Local State").exists()]
+        if len(existing) == 0:
+            return profiles[0]
+        return max(existing, key=lambda profile: (profile / "Local State").stat().st_mtime)
+
+    def is_fresh(self, browser: Browser) -> bool:
+        return time.monotonic() - browser.started < self.standby_max_age
+
+    async def take(self) -> Browser:
+        """Делает активным резервный браузер, если он жив и не устарел, иначе запускает новый"""
+        standby, self.standby = self.standby, None
+        if standby is not None and self.is_fresh(standby) and await self.probe(standby):
+            self.logger.info("Работу подхватывает резервный браузер")
+            self.active = standby
+        else:
+            if standby is not None:
+                await standby.driver.quit()
+            self.active = await self.launch(self.latest_profile())
+        self.rss_checked = time.monotonic()
+        self.prepare_standby()
+        return self.active
+
+    async def fallback(self) -> Browser:
+        """Сессия в копии профиля не поднялась: запускаем Chrome на исходном профиле"""
+        self.logger.warning("Резервный браузер не авторизован, запуск на исходном профиле")
+        source = self.retired_profile
+        await self.retire()
+        self.active = await self.launch(source or self.latest_profile())
+        self.retired_profile = None
+        self.rss_checked = time.monotonic()
+        self.prepare_standby()
+        return self.active
+
+    def prepare_standby(self):
+        """Запускает подготовку резервного браузера, если его нет или он устарел"""
+        if not self.use_standby or self.active is None:
+            return
+        if self.standby_task is not None and not self.standby_task.done():
+            return
+        if self.standby is not None and self.is_fresh(self.standby):
+            return
+        self.standby_task = asyncio.create_task(self.launch_standby())
+
+    async def launch_standby(self):
+        stale, self.standby = self.standby, None
+        if stale is not None:
+            await stale.driver.quit()
+        if self.active is None:
+            # Активный успели закрыть (fallback, перезапуск), резервный подготовит следующий take
+            return
+        source = self.active.profile_dir
+        target = self.data_dir / next(slot for slot in PROFILE_SLOTS if slot != source.name)
+        try:
+            if not await asyncio.to_thread(copy_profile, source, target):
+                self.logger.warning("Сессия менялась во время копирования профиля, резервный браузер не готов")
+                return
+            standby = await self.launch(target, copied=True)
+        except Exception as e:
+            self.logger.error(f"Не удалось подготовить резервный браузер: {e}")
+            return
+        if self.standby is not None or self.active is None or self.active.profile_dir != source:
+            await standby.driver.quit()
+            return
+        self.standby = standby
+        self.logger.info("Резервный браузер готов")
+
+    async def probe(self, browser: Browser | None = None) -> bool:
+        """Проверка живости: браузер отвечает на простую команду за probe_timeout"""
+        browser = browser or self.active
+        if browser is None:
+            return False
+        try:
+            await browser.driver.call(
+                lambda driver: driver.execute_script("return document.readyState"),
+                timeout=self.probe_timeout,
+            )
+            return True
+        except Exception as e:
+            self.logger.warning(f"Браузер не отвечает: {e}")
+            return False
+
+    async def replace_tab(self, handle: str | None) -> str:
+        """Закрывает вкладку и открывает вместо неё новую, возвращает её handle"""
+
+        def replace(driver: webdriver.Chrome) -> str:
+            if handle is not None:
+                driver.switch_to.window(handle)
+            old_handle = driver.current_window_handle
+            driver.switch_to.new_window("tab")
+            block_urls(driver, self.blocked_urls)
+            new_handle = driver.current_window_handle
+            driver.switch_to.window(old_handle)
+            driver.close()
+            driver.switch_to.window(new_handle)
+            return new_handle
+
+        new_handle = await self.active.driver.call(replace)
+        self.active.handles = [new_handle if known == handle else known for known in self.active.handles]
+        return new_handle
+
+    def should_recycle(self) -> bool:
+        if self.active is None:
+            return False
+        if self.recycle_after > 0 and self.active.parsed >= self.recycle_after:
+            self.logger.info(f"Браузер обработал {self.active.parsed} номеров, плановая замена")
+            return True
+        if self.recycle_rss > 0 and time.monotonic() - self.rss_checked >= self.rss_check_interval:
+            self.rss_checked = time.monotonic()
+            rss = self.active.rss()
+            if rss is not None and rss >= self.recycle_rss:
+                self.logger.info(f"Браузер занимает {rss // 2**20} МБ, плановая замена")
+                return True
+        return False
+
+    async def retire(self):
+        """Закрывает активный браузер (перед тем, как take подставит резервный)"""
+        active, self.active = self.active, None
+        if active is not None:
+            self.retired_profile = active.profile_dir
+            await active.driver.quit()
+
+    async def close(self):
+        if self.standby_task is not None:
+            self.standby_task.cancel()
+        await self.retire()
+        standby, self.standby = self.standby, None
+        if standby is not None:
+            await standby.driver.quit()
+
+
+def session_files(profile: Path) -> dict[str, tuple[int, int]]:
+    """Размер и время изменения файлов сессии WhatsApp в профиле"""
+    files = {}
+    for path in profile.rglob("*"):
+        if any(part in SESSION_DIRS for part in path.parts) and path.is_file():
+            with contextlib.suppress(OSError):
+                stat = path.stat()
+                files[str(path.relative_to(profile))] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def copy_profile(source: Path, target: Path) -> bool:
+    """
+    Копия профиля работающего браузера
+        Копия годится, только если ни один файл сессии не пропущен и не менялся во время копирования,
+        иначе пробуем ещё раз (до COPY_ATTEMPTS). Возвращает, удалось ли снять целую копию
+    """
+    for _ in range(COPY_ATTEMPTS):
+        shutil.rmtree(target, ignore_errors=True)
+        if not source.exists():
+            target.mkdir(parents=True, exist_ok=True)
+            return True
+        before = session_files(source)
+        try:
+            shutil.copytree(source, target, ignore=PROFILE_COPY_IGNORE, dirs_exist_ok=True)
+        except shutil.Error as e:
+            skipped = [error[0] for error in e.args[0]]
+            if any(any(part in SESSION_DIRS for part in Path(path).parts) for path in skipped):
+                continue
+        if session_files(source) == before and session_files(target).keys() == before.keys():
+            return True
+    shutil.rmtree(target, ignore_errors=True)
+    return False
@@ -0,0 +1,83 @@
+import os
+from pathlib import Path
+
+from selenium import webdriver
+
+# Всё, что не нужно для открытия чата и аватарки: GPU, расширения, фоновые сервисы Chrome,
+# а также троттлинг фоновых вкладок, из-за которого неактивные вкладки отрисовываются с задержкой
+LEAN_ARGUMENTS = [
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-sync",
+    "--disable-background-networking",
+    "--disable-background-timer-throttling",
+    "--disable-backgrounding-occluded-windows",
+    "--disable-renderer-backgrounding",
+    "--disable-features=Translate,MediaRouter,OptimizationHints",
+    "--no-first-run",
+    "--mute-audio",
+]
+
+LEAN = "lean"
+
+
+def chrome_options(
+    user_data_dir: Path, headless_mode: str | None, profile: str
+) -> webdriver.ChromeOptions:
+    options = webdriver.ChromeOptions()
+    if headless_mode:
+        # Настоящий headless Chrome ("new" или "old") включается только явно, см. selenium.headless_mode
+        options.add_argument(f"--headless={headless_mode}")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--allow-profiles-outside-user-dir")
+    options.add_experimental_option("detach", True)
+    options.add_experimental_option("excludeSwitches", ["enable-logging"])
+    options.add_argument("--enable-profile-shortcut-manager")
+    options.add_argument(f"--user-data-dir={user_data_dir}")
+    options.add_argument("--profile-directory=Profile 1")
+    if profile == LEAN:
+        for argument in LEAN_ARGUMENTS:
+            options.add_argument(argument)
+    return options
+
+
+def block_urls(driver: webdriver.Chrome, patterns: list[str]):
+    """
+    Запрещает текущей вкладке загружать адреса по шаблонам (* - любая подстрока)
+        CDP-команды chromedriver действуют на текущую вкладку, поэтому вызывается для каждой
+    """
+    if len(patterns) == 0:
+        return
+    driver.execute_cdp_cmd("Network.enable", {})
+    driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(patterns)})
+
+
+def process_tree_rss(root_pid: int) -> int | None:
+    """Суммарный RSS (байт) процесса и всех его потомков по /proc, None там, где /proc нет"""
+    proc = Path("/proc")
+    if not proc.exists():
+        return None
+    children: dict[int, list[int]] = {}
+    for entry in proc.iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            # Имя процесса в скобках может содержать пробелы, поэтому режем по последней ")"
+            ppid = int((entry / "stat").read_text().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        try:
+            total += int((proc / str(pid) / "statm").read_text().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            pass
+        stack.extend(children.get(pid, []))
+    return total
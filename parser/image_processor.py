@@ -0,0 +1,89 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+IMAGE_FORMATS = ("WEBP", "JPEG", "PNG")
+
+
+def transcode(
+    data: bytes, image_format: str, quality: int, scale: float, max_size: int
+) -> bytes:
+    """
+    Декодирует скриншот/исходник фотографии, уменьшает и кодирует в нужный формат
+        Выполняется в процессе пула, поэтому функция должна оставаться на уровне модуля
+    """
+    image = Image.open(BytesIO(data))
+    if scale != 1:
+        image = image.resize(
+            (max(1, int(image.size[0] * scale)), max(1, int(image.size[1] * scale))),
+            Image.LANCZOS,
+        )
+    if max_size > 0:
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+
+    output = BytesIO()
+    if image_format == "PNG":
+        # У PNG нет понятия качества, только степень сжатия
+        image.save(output, "PNG", optimize=True)
+    elif image_format == "JPEG":
+        image.convert("RGB").save(output, "JPEG", quality=quality, optimize=True)
+    else:
+        image.save(output, "WEBP", quality=quality, method=4)
+    return output.getvalue()
+
+
+def image_extension(data: bytes | memoryview) -> str:
+    header = bytes(data[:12])
+    if header.startswith(b"\x89PNG"):
+        return "png"
+    if header.startswith(b"\xff\xd8"):
+        return "jpg"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return "bin"
+
+
+class ImageProcessor:
+    """
+    Отдельная стадия обработки фотографий на пуле процессов
+        Перекодирование занимает CPU и не должно тормозить цикл, который управляет браузером
+    """
+
+    image_format: str
+    quality: int
+    scale: float
+    max_size: int
+    executor: ProcessPoolExecutor
+
+    def __init__(
+        self,
+        image_format: str = "PNG",
+        quality: int = 80,
+        scale: float = 0.5,
+        max_size: int = 0,
+        workers: int = 1,
+    ):
+        image_format = image_format.upper()
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Неизвестный формат фотографий: {image_format}")
+        self.image_format = image_format
+        self.quality = quality
+        self.scale = scale
+        self.max_size = max_size
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    async def process(self, data: bytes) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            transcode,
+            data,
+            self.image_format,
+            self.quality,
+            self.scale,
+            self.max_size,
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import time
 from pathlib import Path
 from sys import platform
 from typing import Protocol, Any
@@ -7,124 +8,342 @@ from config import settings
 
 if platform == "linux" and not settings.selenium.headless:
     import xvfbwrapper
-from selenium import webdriver
-from selenium.common import WebDriverException
-
-from database import get_session, get_actual_number, Number
+from database import writer, claim_numbers, save_results, photo_store, Number
+from metrics import registry
+from parser.async_driver import AsyncDriver
 from parser.basic_log_in_impl import BasicLogInImpl
 from parser.basic_parser_impl import BasicParserImpl
+from parser.browser_manager import BrowserManager
+from parser.image_processor import ImageProcessor
+from parser.rate_scheduler import RateScheduler
 from services.base_sender_service import BaseSenderService
 
+# Ступени восстановления (см. Parser.recover) и плановая замена браузера
+RELOAD = "reload"
+NEW_TAB = "new_tab"
+RESTART = "restart"
+RECYCLE = "recycle"
+
+# Метрики: запись в базу (label op), пачка номеров целиком, срабатывания восстановления (label tier)
+DB_SECONDS = "parser_db_seconds"
+BATCH_SECONDS = "parser_batch_seconds"
+RECOVERY_TOTAL = "parser_recovery_total"
+
 
 class BaseParserImpl(Protocol):
-    async def parse(self, number: Number):
+    async def parse(self, number: Number) -> Exception | None:
         pass
 
 
 class BaseLogInImpl(Protocol):
-    def log_in(self, timeout: int, screenshot_filename: Path) -> bool:
+    async def log_in(self, timeout: int, screenshot_filename: Path) -> bool:
         pass
 
 
 class Parser:
-    display: Any
-    parser: BaseParserImpl
+    display: Any = None
+    parsers: list[BasicParserImpl]
+    tab_failures: list[int]
+    recovery_stats: dict[str, int]
     user_logger: BaseLogInImpl
     sender: BaseSenderService | None = None
 
-    driver: webdriver.Chrome | None = None
+    browsers: BrowserManager | None = None
+    driver: AsyncDriver | None = None
+    image_processor: ImageProcessor | None = None
+    scheduler: RateScheduler | None = None
 
     whatsapp_logged_in: bool = False
     logger: logging.Logger = logging.getLogger("Parser")
 
-    async def parse(self):
+    def __init__(self):
+        self.parsers = []
+        self.tab_failures = []
+        self.recovery_stats = {RELOAD: 0, NEW_TAB: 0, RESTART: 0, RECYCLE: 0}
+
+    async def start_browser(self):
+        """Поднимает браузер (резервный, если он готов) и создаёт парсеры для его вкладок"""
+        if self.browsers is None:
+            if platform == "linux" and not settings.selenium.headless:
+                self.display = xvfbwrapper.Xvfb()
+                self.display.start()
+            self.browsers = BrowserManager(
+                Path(settings.selenium.chromedriver_path).absolute(),
+                Path(settings.selenium.chromedriver_data_dir).absolute(),
+                # selenium.headless только отключает Xvfb, режим Chrome задаёт отдельный ключ
+                settings.selenium.get("headless_mode"),
+                settings.parser.browser.profile,
+                list(settings.parser.browser.blocked_urls),
+                settings.parser.tabs,
+                settings.selenium.get("command_timeout") or None,
+                settings.parser.browser.standby,
+                settings.parser.browser.recycle_after,
+                settings.parser.browser.recycle_rss_mb,
+                settings.parser.browser.probe_timeout,
+                settings.parser.browser.standby_max_age,
+            )
+        browser = await self.browsers.take()
+        logged_in = False
+        if browser.copied:
+            # Резервный браузер работает на копии профиля: если сессия в ней не поднялась,
+            # возвращаемся на исходный профиль, а не просим отсканировать QR-код заново
+            logged_in = await BasicLogInImpl(browser.driver, settings.parser.log_in_url).is_logged_in(
+                settings.selenium.log_in_timeout
+            )
+            if not logged_in:
+                browser = await self.browsers.fallback()
+        self.driver = browser.driver
+        self.parsers = self.open_tabs(browser.handles)
+        self.tab_failures = [0] * len(self.parsers)
+        self.user_logger = BasicLogInImpl(self.driver, settings.parser.log_in_url)
+        # Сессию WhatsApp в новом браузере нужно подтвердить заново
+        self.whatsapp_logged_in = logged_in
+
+    def recovered(self, tier: str, count: int = 1):
+        self.recovery_stats[tier] += count
+        registry.inc(RECOVERY_TOTAL, count, tier=tier)
+
+    async def restart_browser(self, reason: str):
+        """
+        Закрывает текущий браузер и переходит на резервный (или запускает новый)
+            Старый закрывается первым, чтобы WhatsApp не увидел одну сессию в двух окнах
+        """
+        self.logger.warning(f"Перезапуск браузера: {reason}")
+        self.driver = None
+        await self.browsers.retire()
+        await self.start_browser()
+
+    async def recover(self, outcomes: list[Exception | None]):
+        """
+        Ступенчатое восстановление после неудачных номеров
+            1. Вкладка с ошибкой открывает следующий номер полной загрузкой (BasicParserImpl сбрасывает app_loaded)
+            2. После parser.browser.tab_failures ошибок подряд вкладка закрывается и открывается заново
+            3. Если браузер не отвечает на проверку живости, он перезапускается
+        """
+        failed = [index for index, outcome in enumerate(outcomes) if outcome is not None]
+        for index, outcome in enumerate(outcomes):
+            self.tab_failures[index] = self.tab_failures[index] + 1 if outcome is not None else 0
+        if len(failed) == 0:
+            return
+        self.recovered(RELOAD, len(failed))
+        if not await self.browsers.probe():
+            self.recovered(RESTART)
+            await self.restart_browser("браузер не отвечает")
+            return
+        for index in failed:
+            if self.tab_failures[index] < settings.parser.browser.tab_failures:
+                continue
+            parser = self.parsers[index]
+            parser.window_handle = await self.browsers.replace_tab(parser.window_handle)
+            parser.app_loaded = False
+            self.tab_failures[index] = 0
+            self.recovered(NEW_TAB)
+            self.logger.warning(f"Вкладка {index} заменена новой после ошибок подряд")
+
+    async def wait_logged_in(self):
+        while not self.whatsapp_logged_in:
+            # В headless режиме сделать авторизацию через бота
+            self.logger.info(
+                "Пользователь не авторизован. Ожидаю авторизацию..."
+            )
+            self.whatsapp_logged_in = await self.user_logger.log_in(
+                settings.selenium.log_in_timeout,
+                Path(settings.selenium.log_in_screen_filename)
+            )
+
+    async def claim(self, limit: int | None) -> list[Number]:
+        with registry.timer(DB_SECONDS, op="claim"):
+            return await writer.submit(
+                lambda session: claim_numbers(
+                    session,
+                    min(limit or len(self.parsers), len(self.parsers)),
+                    settings.parser.lease_timeout,
+                    settings.enable_offline_mode,
+                )
+            )
+
+    async def save(self, numbers: list[Number]):
+        """Записывает итоги пачки и снимает удержание её фотографий, даже если запись не удалась"""
+        try:
+            with registry.timer(DB_SECONDS, op="save"):
+                await writer.submit(lambda session: save_results(session, numbers))
+        finally:
+            photo_store.release(
+                [number.image_hash for number in numbers if number.image_hash is not None]
+            )
+
+    def record(self, outcomes: list[Exception | None]):
+        """Итоги попыток для RateScheduler (без start_parsing его нет)"""
+        if self.scheduler is not None:
+            self.scheduler.record(outcomes)
+
+    async def after_batch(self, numbers: list[Number], outcomes: list[Exception | None]):
+        """Будит отправку результатов, восстанавливает вкладки после ошибок и при необходимости меняет браузер"""
+        if self.sender is not None:
+            self.sender.notify()
+        self.browsers.active.parsed += len(numbers)
+        await self.recover(outcomes)
+        if self.driver is not None and self.browsers.should_recycle():
+            self.recovered(RECYCLE)
+            await self.restart_browser("плановая замена")
+        # Устаревший резервный браузер пересоздаётся на свежей копии профиля
+        self.browsers.prepare_standby()
+
+    async def parse(self, limit: int | None = None) -> int:
+        """Парсит до limit номеров (по умолчанию - по одному на вкладку), возвращает, сколько взято в работу"""
         try:
             if self.driver is None:
-                if platform == 'linux' and not settings.selenium.headless:
-                    self.display = xvfbwrapper.Xvfb()
-                    self.display.start()
-                try:
-                    options = webdriver.ChromeOptions()
-                    # options.add_argument("--headless")
-                    options.add_argument("--disable-dev-shm-usage")
-                    options.add_argument("--allow-profiles-outside-user-dir")
-                    options.add_experimental_option("detach", True)
-                    options.add_experimental_option("excludeSwitches", ["enable-logging"])
-                    options.add_argument("--enable-profile-shortcut-manager")
-                    chromedriver_data_dir: Path = Path(
-                        settings.selenium.chromedriver_data_dir
-                    ).absolute()
-                    options.add_argument(
-                        f'--user-data-dir={chromedriver_data_dir / "user"}'
-                    )
-                    options.add_argument("--profile-directory=Profile 1")
-
-                    chromedriver_data_dir: Path = Path(
-                        settings.selenium.chromedriver_path
-                    ).absolute()
-                    self.driver = webdriver.Chrome(
-                        executable_path=(
-                            chromedriver_data_dir
-                            if platform != "win32" and (".exe" not in str(chromedriver_data_dir))
-                            else str(chromedriver_data_dir) + ".exe"
-                        ),
-                        options=options,
-                    )
-                except WebDriverException as e:
-                    self.logger.error(e)
-                    raise RuntimeError("Не удалось запустить chromedriver")
-                self.parser = BasicParserImpl(
-                    self.driver,
-                    settings.parser.url,
-                    settings.parser.webdriver_timeout,
-                    settings.parser.photos_dir,
+                await self.start_browser()
+
+            try:
+                await self.wait_logged_in()
+                actual_numbers = await self.claim(limit)
+                if len(actual_numbers) == 0:
+                    return 0
+
+                self.logger.info(
+                    f"Парсинг номеров: {[number.number for number in actual_numbers]}"
                 )
-                self.user_logger = BasicLogInImpl(self.driver)
-
-            async with get_session() as session:
-                try:
-                    while not self.whatsapp_logged_in:
-                        # В headless режиме сделать авторизацию через бота
-                        self.logger.info(
-                            "Пользователь не авторизован. Ожидаю авторизацию..."
-                        )
-                        self.whatsapp_logged_in = self.user_logger.log_in(
-                            settings.selenium.log_in_timeout,
-                            Path(settings.selenium.log_in_screen_filename)
-                        )
-
-                    actual_number: Number | None = await get_actual_number(session)
-                    if actual_number is None:
-                        return
-
-                    self.logger.info(f"Парсинг номера: {actual_number.number}")
-                    await self.parser.parse(actual_number)
-                    await session.commit()
-                except Exception as e:
-                    self.logger.error(e)
-                    await session.rollback()
-                    self.driver.quit()
+                with registry.timer(BATCH_SECONDS):
+                    outcomes = await asyncio.gather(
+                        *[
+                            parser.parse(number)
+                            for parser, number in zip(self.parsers, actual_numbers)
+                        ]
+                    )
+                await self.save(actual_numbers)
+                self.record(outcomes)
+                await self.after_batch(actual_numbers, outcomes)
+                return len(actual_numbers)
+            except Exception as e:
+                # Не записанные номера вернутся в очередь по истечении аренды
+                self.logger.error(e)
+                self.record([e])
+                if self.driver is not None and not await self.browsers.probe():
+                    self.recovered(RESTART)
                     self.driver = None
-                    if platform == "linux":
-                        self.display.stop()
+                    await self.browsers.retire()
         except Exception as e:
             self.logger.error(e)
+        return 0
+
+    async def parse_scheduled(self) -> int:
+        """Берёт у RateScheduler токены на номера, парсит и возвращает неизрасходованные токены"""
+        granted = await self.scheduler.acquire(settings.parser.tabs)
+        parsed = await self.parse(granted)
+        self.scheduler.refund(granted - parsed)
+        return parsed
+
+    def open_tabs(self, handles: list[str | None]) -> list[BasicParserImpl]:
+        """
+        Создаёт парсеры для уже открытых вкладок браузера.
+            Каждая вкладка получает свой BasicParserImpl, так что пока одна ждёт отрисовки WhatsApp,
+            остальные находятся на других этапах парсинга
+        """
+        if self.image_processor is None:
+            self.image_processor = ImageProcessor(
+                settings.parser.image.format,
+                settings.parser.image.quality,
+                settings.parser.image.scale,
+                settings.parser.image.max_size,
+                settings.parser.image.workers,
+            )
+        self.logger.info(f"Открыто вкладок: {len(handles)}")
+
+        return [
+            BasicParserImpl(
+                self.driver,
+                settings.parser.url,
+                settings.parser.webdriver_timeout,
+                photo_store,
+                self.image_processor,
+                window_handle=handle,
+                poll_interval=settings.parser.poll_interval,
+                navigation=settings.parser.navigation.mode,
+                in_app_url=settings.parser.navigation.in_app_url,
+                in_app_timeout=settings.parser.navigation.in_app_timeout,
+                max_in_app_failures=settings.parser.navigation.max_in_app_failures,
+                photo_capture=settings.parser.photo_capture,
+                source_timeout=settings.parser.photo_source_timeout,
+                transcode_source=settings.parser.image.transcode_source,
+            )
+            for handle in handles
+        ]
 
     async def start_parsing(self):
+        """
+        Парсит номера в темпе, который задаёт RateScheduler (settings.parser.rate).
+            settings.parser.batch_size - запас токенов, то есть сколько номеров можно взять подряд без пауз
+            (не меньше числа вкладок, иначе часть вкладок простаивала бы),
+            wait_interval - пауза, когда очередь пуста или браузер не поднялся
+        """
+        if self.scheduler is None:
+            self.scheduler = RateScheduler(
+                settings.parser.rate.initial,
+                settings.parser.rate.min,
+                settings.parser.rate.max,
+                # Запас меньше числа вкладок оставлял бы лишние вкладки без номеров
+                max(settings.parser.batch_size, settings.parser.tabs),
+                settings.parser.rate.increase,
+                settings.parser.rate.decrease,
+                settings.parser.rate.window,
+                settings.parser.rate.threshold,
+            )
+        stats_logged = time.monotonic()
         while True:
-            try:
-                await self.parse()
-                # TODO: Мне кажется можно изменить структуру так, чтобы это было хотя бы немного более... элегантно?
-                if self.sender is not None:
-                    await self.sender.send_data()
-            finally:
+            parsed = await self.parse_scheduled()
+            if parsed == 0:
                 await asyncio.sleep(settings.parser.wait_interval)
+            else:
+                self.logger.debug(
+                    f"Скорость парсинга: {self.scheduler.stats()}, переходы: {self.navigation_stats()}"
+                )
+            if time.monotonic() - stats_logged >= settings.parser.browser.stats_interval:
+                stats_logged = time.monotonic()
+                self.logger.info(f"Браузер: {self.browser_stats()}, восстановление: {self.recovery_stats}")
+
+    def browser_stats(self) -> dict:
+        """Память всего дерева процессов Chrome (МБ) и среднее время полной загрузки страницы (мс)"""
+        stats = {}
+        if self.browsers is not None and self.browsers.active is not None:
+            rss = self.browsers.active.rss()
+            if rss is not None:
+                stats["rss_mb"] = round(rss / 2**20, 1)
+            stats["parsed"] = self.browsers.active.parsed
+            stats["standby"] = self.browsers.standby is not None
+        page_loads = sum(parser.page_loads for parser in self.parsers)
+        if page_loads > 0:
+            stats["page_load_ms"] = round(
+                sum(parser.page_load_seconds for parser in self.parsers) / page_loads * 1000
+            )
+        return stats
+
+    def navigation_stats(self) -> dict[str, int]:
+        """
+        Сколько раз чат открывался полной загрузкой, внутри приложения и откатом с него на загрузку,
+        и сколько фотографий снято из исходного файла, а сколько скриншотом
+        """
+        totals: dict[str, int] = {}
+        for parser in self.parsers:
+            stats = {**parser.navigation_stats, **parser.capture_stats}
+            for path, count in stats.items():
+                totals[path] = totals.get(path, 0) + count
+        return totals
+
+    async def shutdown(self):
+        """Закрывает активный и резервный браузеры и останавливает обработку картинок"""
+        self.driver = None
+        if self.browsers is not None:
+            await self.browsers.close()
+        if self.display is not None:
+            self.display.stop()
+            self.display = None
+        if self.image_processor is not None:
+            self.image_processor.shutdown()
 
-    @staticmethod
-    async def start():
-        parser = Parser()
+    async def start(self):
+        # Запускаем именно этот экземпляр: AppContainer передаёт ему sender до старта
         try:
-            await parser.start_parsing()
+            await self.start_parsing()
         finally:
-            if parser.driver is not None:
-                parser.driver.quit()
+            await self.shutdown()
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from selenium.common import TimeoutException
+
+OK = "ok"
+TIMEOUT = "timeout"
+ERROR = "error"
+
+
+def classify(outcome: Exception | None) -> str:
+    if outcome is None:
+        return OK
+    if isinstance(outcome, (TimeoutException, asyncio.TimeoutError)):
+        return TIMEOUT
+    return ERROR
+
+
+class RateScheduler:
+    """
+    Темп парсинга: token bucket со скоростью rate номеров в минуту и запасом burst номеров
+        Скорость подстраивается по AIMD: пока номера парсятся без ошибок, она растёт на increase
+        за каждый номер, делённый на текущую скорость (т.е. примерно на increase в минуту), а когда доля
+        таймаутов и ошибок за последние window номеров превышает threshold - умножается на decrease.
+        Неудачная попытка номера - это и есть SECONDCHECK, так что его доля учитывается тут же.
+        Номер, для которого WhatsApp показал диалог "номер не зарегистрирован", - это успешный парсинг
+    """
+
+    rate: float
+    min_rate: float
+    max_rate: float
+    burst: int
+    increase: float
+    decrease: float
+    threshold: float
+    tokens: float
+    updated: float
+    outcomes: deque[str]
+    totals: dict[str, int]
+    logger: logging.Logger
+
+    def __init__(
+        self,
+        rate: float,
+        min_rate: float,
+        max_rate: float,
+        burst: int,
+        increase: float,
+        decrease: float,
+        window: int,
+        threshold: float,
+        logger: logging.Logger = logging.getLogger("RateScheduler"),
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = max(burst, 1)
+        self.increase = increase
+        self.decrease = decrease
+        self.threshold = threshold
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.outcomes = deque(maxlen=window)
+        self.totals = {OK: 0, TIMEOUT: 0, ERROR: 0}
+        self.logger = logger
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate / 60)
+        self.updated = now
+
+    async def acquire(self, count: int) -> int:
+        """Ждёт хотя бы один токен и забирает до count штук, возвращает, сколько удалось взять"""
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                granted = min(count, int(self.tokens))
+                self.tokens -= granted
+                return granted
+            await asyncio.sleep((1 - self.tokens) * 60 / self.rate)
+
+    def refund(self, count: int):
+        """Возвращает токены, под которые не нашлось номеров"""
+        if count > 0:
+            self.tokens = min(self.burst, self.tokens + count)
+
+    def record(self, outcomes: list[Exception | None]):
+        if len(outcomes) == 0:
+            return
+        for outcome in outcomes:
+            kind = classify(outcome)
+            self.totals[kind] += 1
+            self.outcomes.append(kind)
+
+        failures = sum(1 for kind in self.outcomes if kind != OK)
+        if failures / len(self.outcomes) > self.threshold:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            # Окно начинаем заново, иначе одни и те же ошибки роняли бы скорость на каждом номере
+            self.outcomes.clear()
+            self.tokens = min(self.tokens, 1)
+            self.logger.warning(f"Много ошибок, снижаю скорость до {self.rate:.1f} номеров/мин")
+        elif all(classify(outcome) == OK for outcome in outcomes):
+            self.rate = min(self.max_rate, self.rate + self.increase * len(outcomes) / self.rate)
+
+    def stats(self) -> dict:
+        return {"rate": self.rate, **self.totals}
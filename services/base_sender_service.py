@@ -8,5 +8,12 @@ class BaseSenderService(ABC):
     def __init__(self, logger: logging.Logger):
         self.logger = logger
 
-    async def send_data(self):
+    async def send_data(self, limit: int) -> int:
+        raise NotImplementedError
+
+    def notify(self):
+        """Сообщает сервису, что появились новые результаты для отправки"""
+        pass
+
+    async def start(self):
         raise NotImplementedError
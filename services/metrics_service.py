@@ -0,0 +1,70 @@
+import asyncio
+import json
+import logging
+from pathlib import Path
+
+import metrics
+from config import settings
+
+
+class MetricsService:
+    """
+    Выгрузка метрик основного процесса (парсер, приём номеров, отправка результатов)
+        Раз в settings.metrics.interval секунд пишет снимок в settings.metrics.snapshot_file - его читает
+        слушатель zmq, который живёт в отдельном процессе. Дополнительно может писать текст Prometheus
+        в prometheus_file и отдавать его по HTTP на 127.0.0.1:prometheus_port (0 - выключено)
+    """
+
+    interval: float
+    snapshot_file: Path
+    prometheus_file: Path | None
+    prometheus_port: int
+    logger: logging.Logger
+
+    def __init__(self, logger: logging.Logger = logging.getLogger("MetricsService")):
+        self.interval = settings.metrics.interval
+        self.snapshot_file = Path(settings.metrics.snapshot_file)
+        self.prometheus_file = (
+            Path(settings.metrics.prometheus_file) if settings.metrics.prometheus_file else None
+        )
+        self.prometheus_port = settings.metrics.prometheus_port
+        self.logger = logger
+
+    def export(self):
+        snapshot = metrics.registry.snapshot()
+        metrics.write_atomic(self.snapshot_file, json.dumps(snapshot))
+        if self.prometheus_file is not None:
+            metrics.write_atomic(self.prometheus_file, metrics.prometheus_text(snapshot))
+
+    async def serve_prometheus(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Путь запроса не важен: любой GET получает текущие метрики
+            await reader.readuntil(b"\r\n\r\n")
+            body = metrics.prometheus_text(metrics.registry.snapshot()).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        server = None
+        if self.prometheus_port:
+            server = await asyncio.start_server(self.serve_prometheus, "127.0.0.1", self.prometheus_port)
+            self.logger.info(f"Метрики Prometheus: http://127.0.0.1:{self.prometheus_port}/metrics")
+        try:
+            while True:
+                try:
+                    self.export()
+                except OSError as e:
+                    self.logger.error(f"Не удалось выгрузить метрики: {e}")
+                await asyncio.sleep(self.interval)
+        finally:
+            if server is not None:
+                server.close()
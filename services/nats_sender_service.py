@@ -1,16 +1,34 @@
 import asyncio
 import logging
-from typing import Callable, Awaitable
+import time
+from typing import Callable, Awaitable, Optional
 
-import nats.js.errors
 from nats.aio.client import Client
-from nats.js.kv import KeyValue
 from pydantic import BaseModel
-from sqlalchemy import delete
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 import utils
-from database import get_session, get_handled_numbers, Number, NumberStatus
+from config import settings
+from database import (
+    get_session,
+    writer,
+    get_handled_numbers,
+    get_uploaded_hashes,
+    mark_uploaded,
+    photo_store,
+    Number,
+    NumberStatus,
+)
+from metrics import registry
 from services.base_sender_service import BaseSenderService
+from services.result_store import BaseResultStore, NatsResultStore
+
+# Метрики отправки: этапы пачки (label stage), отправленные номера и фотографии, ошибки
+STAGE_SECONDS = "sender_stage_seconds"
+NUMBERS_TOTAL = "sender_numbers_total"
+PHOTOS_TOTAL = "sender_photos_total"
+ERRORS_TOTAL = "sender_errors_total"
 
 
 class NumberResult(BaseModel):
@@ -18,81 +36,174 @@ class NumberResult(BaseModel):
     id: int  # server_id
     number: str
     photo: bool = False
+    # Имя объекта с фотографией в Object Store (sha256 содержимого)
+    photo_hash: Optional[str] = None
 
 
 class NatsSenderService(BaseSenderService):
     send_timeout: int
+    retry_timeout: int
+    batch_size: int
+    min_batch_size: int
+    max_batch_size: int
+    results_ready: asyncio.Event
     user_id: int
     nc: Callable[[], Awaitable[Client]]
+    result_store: BaseResultStore
 
     def __init__(
         self,
         user_id: int,
         get_nc: Callable[[], Awaitable[Client]],
         logger: logging.Logger = logging.getLogger("NatsSenderService"),
+        result_store: BaseResultStore | None = None,
     ):
         super().__init__(logger)
-        self.send_timeout = 10
+        self.send_timeout = settings.sender.send_timeout
+        self.retry_timeout = settings.sender.retry_timeout
+        self.min_batch_size = settings.sender.min_batch_size
+        self.max_batch_size = settings.sender.max_batch_size
+        self.batch_size = self.min_batch_size
+        self.results_ready = asyncio.Event()
         self.user_id = user_id
         self.nc = get_nc
+        self.result_store = result_store or NatsResultStore(
+            get_nc,
+            photo_store,
+            settings.sender.bucket,
+            settings.sender.chunk_size,
+            settings.sender.max_in_flight,
+        )
 
-    async def save_number_to_object_store(self, kv: KeyValue, number: Number) -> str:
-        try:
-            if number.status != NumberStatus.COMPLETED:
-                return number.number
-            number = await kv.get(number.number)
-            await kv.put(number.number, number.image)
-        except nats.js.errors.KeyNotFoundError:
-            await kv.create(number.number, number.image)
-        except Exception as e:
-            self.logger.error(e)
-            await kv.delete(number.number)
-        return number.number
-
-    async def send_data(self):
-        async with get_session() as session:
-            try:
-                js = (await self.nc()).jetstream()
-                # TODO: поменять на Object Store, когда его добавят в библиотеку
-                kv = await js.create_key_value(bucket="data_store")
-                numbers: list[Number] = await get_handled_numbers(session, 5)
-                if numbers is None or len(numbers) == 0:
-                    return
-                self.logger.debug(numbers)
-                n = await asyncio.gather(
-                    *[
-                        self.save_number_to_object_store(kv, number)
-                        for number in numbers
-                    ],
-                    return_exceptions=False,
+    @staticmethod
+    async def finish_batch(
+        session: AsyncSession, numbers: list[Number], new_hashes: set[str]
+    ) -> set[str]:
+        """Удаляет отправленные номера и возвращает хеши фотографий, на которые больше никто не ссылается"""
+        await mark_uploaded(session, new_hashes)
+        await session.execute(
+            delete(Number).where(Number.id.in_([number.id for number in numbers]))
+        )
+        hashes = {number.image_hash for number in numbers if number.image_hash is not None}
+        still_used = set(
+            (
+                await session.scalars(
+                    select(Number.image_hash).where(Number.image_hash.in_(hashes))
                 )
+            ).all()
+        )
+        return hashes - still_used
 
-                self.logger.info(
-                    f"Полетела пачка {len([True for number in numbers if number.status == NumberStatus.COMPLETED])}"
-                    f" из {len(numbers)} фотачек"
+    @staticmethod
+    async def discard_orphans(session: AsyncSession, hashes: set[str]) -> set[str]:
+        """
+        Удаляет файлы фотографий, если на них по-прежнему никто не ссылается
+            Отдельное задание писателя уже после коммита finish_batch: если бы файлы удалялись в его
+            транзакции, откат оставил бы строки без фотографий. Пока задание выполняется, save_results
+            парсера не вклинится между проверкой ссылок и удалением, а фотографии, которые парсер сохранил,
+            но ещё не записал в базу, PhotoStore удерживает
+        """
+        if len(hashes) == 0:
+            return set()
+        still_used = set(
+            (
+                await session.scalars(
+                    select(Number.image_hash).where(Number.image_hash.in_(hashes))
                 )
+            ).all()
+        )
+        return photo_store.discard(hashes - still_used)
+
+    async def send_data(self, limit: int = 5) -> int:
+        """Отправляет одну пачку обработанных номеров, возвращает её размер"""
+        read_started = time.perf_counter()
+        async with get_session() as session:
+            numbers: list[Number] = await get_handled_numbers(session, limit)
+            if numbers is None or len(numbers) == 0:
+                return 0
+            self.logger.debug(numbers)
+
+            # Одинаковые фотографии (дефолтные аватарки, логотипы) отгружаются один раз,
+            # повторы уходят на сервер только ссылкой на хеш
+            photo_hashes = {
+                number.image_hash
+                for number in numbers
+                if number.status == NumberStatus.COMPLETED and number.image_hash is not None
+            }
+            new_hashes = photo_hashes - await get_uploaded_hashes(session, photo_hashes)
+        # Пустые опросы очереди в гистограмму не попадают
+        registry.observe(STAGE_SECONDS, time.perf_counter() - read_started, stage="read")
+
+        with registry.timer(STAGE_SECONDS, stage="photos"):
+            await asyncio.gather(
+                *[
+                    self.result_store.put_photo(photo_hash, photo_hash)
+                    for photo_hash in new_hashes
+                ]
+            )
 
-                await asyncio.gather(
-                    *[
-                        js.publish(
-                            subject="server.data",
-                            stream="data",
-                            payload=utils.pack_msg(
-                                NumberResult(
-                                    user_id=self.user_id,
-                                    id=number.server_id,
-                                    number=number.number,
-                                    photo=number.status == NumberStatus.COMPLETED,
-                                )
-                            ),
+        self.logger.info(
+            f"Полетела пачка {len(numbers)} номеров: {len(photo_hashes)} фотачек,"
+            f" из них новых {len(new_hashes)}"
+        )
+
+        with registry.timer(STAGE_SECONDS, stage="publish"):
+            await asyncio.gather(
+                *[
+                    self.result_store.publish_result(
+                        utils.pack_msg(
+                            NumberResult(
+                                user_id=self.user_id,
+                                id=number.server_id,
+                                number=number.number,
+                                photo=number.status == NumberStatus.COMPLETED,
+                                photo_hash=(
+                                    number.image_hash
+                                    if number.status == NumberStatus.COMPLETED
+                                    else None
+                                ),
+                            )
                         )
-                        for number in numbers
-                    ]
-                )
-                await session.execute(delete(Number).where(Number.number.in_(n)))
-                await session.commit()
+                    )
+                    for number in numbers
+                ]
+            )
+        with registry.timer(STAGE_SECONDS, stage="finish"):
+            orphaned = await writer.submit(
+                lambda session: self.finish_batch(session, numbers, new_hashes)
+            )
+            self.result_store.uploaded(new_hashes)
+            await writer.submit(lambda session: self.discard_orphans(session, orphaned))
+        registry.inc(NUMBERS_TOTAL, len(numbers))
+        registry.inc(PHOTOS_TOTAL, len(new_hashes))
+        return len(numbers)
+
+    def notify(self):
+        self.results_ready.set()
+
+    async def start(self):
+        """
+        Долгоживущая задача отправки результатов
+            Просыпается, когда парсер сообщает о новых результатах (или раз в send_timeout),
+            и выгребает весь накопившийся хвост. Размер пачки растёт вдвое, пока пачки уходят
+            полными, и падает вдвое при ошибках, так что скорость упирается в NATS, а не в таймеры
+        """
+        while True:
+            try:
+                sent = await self.send_data(self.batch_size)
+                if sent == self.batch_size:
+                    self.batch_size = min(self.batch_size * 2, self.max_batch_size)
+                    continue
+                await self.wait_for_results(self.send_timeout)
             except Exception as e:
                 self.logger.error(e)
-                await session.rollback()
-            finally:
-                await asyncio.sleep(self.send_timeout)
+                registry.inc(ERRORS_TOTAL)
+                self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+                await asyncio.sleep(self.retry_timeout)
+
+    async def wait_for_results(self, timeout: float):
+        try:
+            await asyncio.wait_for(self.results_ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.results_ready.clear()
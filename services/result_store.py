@@ -0,0 +1,185 @@
+import asyncio
+import base64
+import json
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from hashlib import sha256
+from typing import Callable, Awaitable
+
+import aiofiles
+import nats.js.errors
+from nats.aio.client import Client
+from nats.js import JetStreamContext, api
+from nats.js.object_store import ObjectStore
+from nats.nuid import NUID
+
+from database import PhotoStore
+
+# Формат хранения Object Store (ADR-20): поток OBJ_<bucket>, куски объекта на $O.<bucket>.C.<nuid>,
+# мета на $O.<bucket>.M.<base64 имени>, последняя мета вытесняет предыдущие (rollup по subject)
+OBJECT_STREAM = "OBJ_{bucket}"
+OBJECT_CHUNKS = "$O.{bucket}.C.{nuid}"
+OBJECT_META = "$O.{bucket}.M.{name}"
+OBJECT_DIGEST = "SHA-256="
+ROLLUP_SUBJECT = "sub"
+
+
+class BaseResultStore(ABC):
+    logger: logging.Logger
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+
+    @abstractmethod
+    async def put_photo(self, name: str, photo_hash: str):
+        pass
+
+    @abstractmethod
+    async def publish_result(self, payload: bytes):
+        pass
+
+    def uploaded(self, names: set[str]):
+        """Фотографии с этими именами отмечены в UploadedPhoto и больше не будут загружаться"""
+
+
+class NatsResultStore(BaseResultStore):
+    """
+    Хранилище результатов в JetStream
+        Контекст JetStream и хендл Object Store живут столько же, сколько соединение, и пересоздаются
+        только при смене клиента или после ошибки.
+        Фотографии публикуются в формате Object Store (куски на новом nuid + мета-сообщение) без
+        ObjectStore.put: тот перед записью читает существующий объект (get_info) и ждёт подтверждения
+        каждого куска. Сюда приходят только хеши, которых нет в UploadedPhoto, так что читать нечего,
+        а куски уходят окнами по max_in_flight. Единственный случай, когда у имени есть прошлая версия, -
+        повтор пачки, упавшей после загрузки фотографии: nuid такой загрузки запоминается до uploaded,
+        и её куски удаляются после записи новой меты, как это делает и ObjectStore.put
+    """
+
+    nc: Callable[[], Awaitable[Client]]
+    photo_store: PhotoStore
+    bucket: str
+    chunk_size: int
+    max_in_flight: int
+    nuid: NUID
+    # Загруженные, но ещё не отмеченные в UploadedPhoto фотографии: имя -> nuid их кусков
+    unconfirmed: dict[str, str]
+
+    _client: Client | None = None
+    _js: JetStreamContext | None = None
+    _object_store: ObjectStore | None = None
+
+    def __init__(
+        self,
+        get_nc: Callable[[], Awaitable[Client]],
+        photo_store: PhotoStore,
+        bucket: str,
+        chunk_size: int,
+        max_in_flight: int,
+        logger: logging.Logger = logging.getLogger("NatsResultStore"),
+    ):
+        super().__init__(logger)
+        self.nc = get_nc
+        self.photo_store = photo_store
+        self.bucket = bucket
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.nuid = NUID()
+        self.unconfirmed = {}
+
+    async def jetstream(self) -> JetStreamContext:
+        nc = await self.nc()
+        if self._js is None or self._client is not nc:
+            self._client = nc
+            self._js = nc.jetstream()
+            self._object_store = None
+        return self._js
+
+    async def object_store(self) -> ObjectStore:
+        js = await self.jetstream()
+        if self._object_store is None:
+            try:
+                self._object_store = await js.object_store(self.bucket)
+            except nats.js.errors.BucketNotFoundError:
+                self._object_store = await js.create_object_store(self.bucket)
+        return self._object_store
+
+    def reset(self):
+        self._client = None
+        self._js = None
+        self._object_store = None
+
+    async def put_photo(self, name: str, photo_hash: str):
+        try:
+            await self._put_photo(name, photo_hash)
+        except Exception:
+            self.reset()
+            raise
+
+    async def _put_photo(self, name: str, photo_hash: str):
+        await self.object_store()
+        js = self._js
+        stream = OBJECT_STREAM.format(bucket=self.bucket)
+        nuid = self.nuid.next().decode()
+        chunk_subject = OBJECT_CHUNKS.format(bucket=self.bucket, nuid=nuid)
+
+        digest = sha256()
+        size = 0
+        chunks = 0
+        try:
+            async with aiofiles.open(self.photo_store.path(photo_hash), "rb") as file:
+                while True:
+                    window = []
+                    for _ in range(self.max_in_flight):
+                        chunk = await file.read(self.chunk_size)
+                        if len(chunk) == 0:
+                            break
+                        digest.update(chunk)
+                        size += len(chunk)
+                        window.append(chunk)
+                    if len(window) == 0:
+                        break
+                    # Публикации уходят в сокет в порядке создания задач, поэтому порядок кусков сохраняется
+                    await asyncio.gather(*[js.publish(chunk_subject, chunk) for chunk in window])
+                    chunks += len(window)
+
+            info = api.ObjectInfo(
+                name=name,
+                bucket=self.bucket,
+                nuid=nuid,
+                size=size,
+                chunks=chunks,
+                mtime=datetime.now(timezone.utc).isoformat(),
+                digest=OBJECT_DIGEST + base64.urlsafe_b64encode(digest.digest()).decode(),
+                options=api.ObjectMetaOptions(max_chunk_size=self.chunk_size),
+            )
+            await js.publish(
+                OBJECT_META.format(
+                    bucket=self.bucket, name=base64.urlsafe_b64encode(name.encode()).decode()
+                ),
+                json.dumps(info.as_dict()).encode(),
+                headers={api.Header.ROLLUP: ROLLUP_SUBJECT},
+            )
+        except Exception:
+            await js.purge_stream(stream, subject=chunk_subject)
+            raise
+
+        previous = self.unconfirmed.get(name)
+        self.unconfirmed[name] = nuid
+        if previous is not None:
+            await js.purge_stream(
+                stream, subject=OBJECT_CHUNKS.format(bucket=self.bucket, nuid=previous)
+            )
+
+    def uploaded(self, names: set[str]):
+        self.unconfirmed = {
+            name: nuid for name, nuid in self.unconfirmed.items() if name not in names
+        }
+
+    async def publish_result(self, payload: bytes):
+        js = await self.jetstream()
+        try:
+            await js.publish(subject="server.data", stream="data", payload=payload)
+        except Exception:
+            self.reset()
+            raise
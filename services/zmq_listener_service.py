@@ -1,15 +1,31 @@
 import asyncio
 import logging
+import re
+import time
+import uuid
 import zipfile
 from pathlib import Path
-from typing import Sequence
+from typing import Optional, Any, Callable, Awaitable
 
 import msgpack
 import zmq
+import zmq.asyncio
 from pydantic import BaseModel
 
+import metrics
 from config import settings
-from database import get_session, get_status, Number, get_handled_numbers
+from database import (
+    get_session,
+    writer,
+    get_status,
+    get_throughput,
+    insert_numbers,
+    NumberStatus,
+    photo_store,
+    count_handled_images,
+    iter_handled_images,
+)
+from parser.image_processor import image_extension
 from services.base_sender_service import BaseSenderService
 
 
@@ -17,26 +33,84 @@ class StatusMessage(BaseModel):
     total: int
     completed: int
     error: int
-    # secondcheck: int # ???
+    secondcheck: int = 0
+    in_progress: int = 0
+    # Номеров в минуту за последние settings.zmq.throughput_window минут
+    throughput: float = 0
+    # Секунд до конца очереди при текущей скорости, None - пока скорость неизвестна
+    eta: Optional[float] = None
 
 
+# Номер в международном формате без "+", как его ждёт ссылка WhatsApp
+PHONE_RE = re.compile(r"[1-9][0-9]{7,14}")
+
 STATUS = "status"
 UPLOAD = "upload"
 DOWNLOAD = "download"
+JOB = "job"
+METRICS = "metrics"
+COMMANDS = (STATUS, UPLOAD, DOWNLOAD, JOB, METRICS)
 ERR = "ERR"
 OK = "OK"
 
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+COMMAND_SECONDS = "listener_command_seconds"
+# Метка для всего, что не входит в COMMANDS: значение команды присылает клиент, и без этого
+# каждая опечатка заводила бы свою гистограмму
+UNKNOWN = "unknown"
+
+
+class Job:
+    """Долгая операция (выгрузка архива), которая выполняется в фоне, пока клиент опрашивает её по id"""
+
+    id: str
+    command: str
+    state: str
+    progress: dict
+    error: str | None = None
+    task: asyncio.Task | None = None
+
+    def __init__(self, command: str):
+        self.id = uuid.uuid4().hex
+        self.command = command
+        self.state = RUNNING
+        self.progress = {}
+
+    async def run(self, coroutine: Callable[[dict], Awaitable[dict]]):
+        try:
+            await coroutine(self.progress)
+            self.state = DONE
+        except Exception as e:
+            self.state = FAILED
+            self.error = str(e)
+            logging.getLogger("ZmqListenerService").error(f"Задание {self.id} упало: {e}")
+
+    def info(self) -> dict:
+        return {
+            "id": self.id,
+            "command": self.command,
+            "state": self.state,
+            "progress": self.progress,
+            "error": self.error,
+        }
+
 
 class ZmqListenerService:
     """
-    Сервис, который, скорее всего будет запущен в отдельной корутине
-        Слушает ipc сокет zmq и обрабатывает команды по модели Req/Rep
-        TODO: Пока что этот сервис - костыль. Логика в нём собрана в кучу, поэтому refactor this asap
+    Сервис, который запускается в отдельном процессе в оффлайн режиме
+        Слушает ROUTER-сокет zmq: каждый запрос обрабатывается своей задачей, так что медленный запрос
+        не задерживает остальных, а клиент, отвалившийся по таймауту, не ломает сокет.
+        Долгие операции (download) запускаются фоновым заданием, ответ содержит его id,
+        по которому клиент опрашивает прогресс командой job
     """
 
     comm_dir: Path
     sender: BaseSenderService
     logger: logging.Logger
+    jobs: dict[str, Job]
 
     def __init__(
         self,
@@ -45,78 +119,161 @@ class ZmqListenerService:
     ):
         self.port = port
         self.logger = logger
+        self.jobs = {}
 
     async def status(self) -> StatusMessage:
         async with get_session() as session:
-            status = await get_status(session)
-            return StatusMessage(total=status[0], completed=status[1], error=status[2])
+            counts = await get_status(session, offline=True)
+            throughput = await get_throughput(
+                session, offline=True, window=settings.zmq.throughput_window
+            )
+        backlog = (
+            counts[NumberStatus.CREATED]
+            + counts[NumberStatus.IN_PROGRESS]
+            + counts[NumberStatus.SECONDCHECK]
+        )
+        return StatusMessage(
+            total=sum(counts.values()),
+            completed=counts[NumberStatus.COMPLETED],
+            error=counts[NumberStatus.ERROR],
+            secondcheck=counts[NumberStatus.SECONDCHECK],
+            in_progress=counts[NumberStatus.IN_PROGRESS],
+            throughput=throughput,
+            eta=backlog / throughput * 60 if throughput > 0 else None,
+        )
 
-    # Все проверки на валидность номеров производятся на стороне отправителя
-    async def upload(self, numbers: list[str]):
-        async with get_session() as session:
-            try:
-                nums = [Number(number=number) for number in numbers]
-                session.add_all(nums)
-                await session.commit()
-            except Exception as e:
-                await session.rollback()
-                self.logger.error(e)
-
-    async def download(self, filename: str, password: str):
+    async def upload(self, numbers: list[str]) -> dict:
+        """
+        Добавляет пачку номеров одним INSERT OR IGNORE
+            Дубликаты (в том числе внутри пачки) отсекает база и не ломают остальную пачку.
+            Возвращает количество добавленных, дубликатов и отброшенных невалидных номеров
+        """
+        valid = [
+            number for number in numbers if isinstance(number, str) and PHONE_RE.fullmatch(number)
+        ]
+        accepted = await writer.submit(
+            lambda session: insert_numbers(session, [{"number": number} for number in valid])
+        )
+        return {
+            "accepted": accepted,
+            "duplicate": len(valid) - accepted,
+            "invalid": len(numbers) - len(valid),
+        }
+
+    async def download(self, filename: str, password: str, progress: dict | None = None) -> dict:
+        """
+        Потоково выгружает фотографии в архив
+            Номера читаются пачками по settings.zmq.export_chunk_size и сразу пишутся в архив,
+            поэтому память не растёт вместе с размером выгрузки. Запись пачки в zip идёт в отдельном
+            потоке, чтобы цикл событий успевал отвечать на другие запросы.
+            progress обновляется по ходу выгрузки (см. Job)
+        """
+        progress = progress if progress is not None else {}
         output_file = Path(filename)
         if not output_file.absolute().exists():
             output_file.parent.mkdir(parents=True, exist_ok=True)
+        progress["exported"] = 0
         async with get_session() as session:
-            numbers: Sequence[Number] = await get_handled_numbers(session)
+            progress["total"] = await count_handled_images(session, offline=True)
             with zipfile.ZipFile(output_file, "w") as file:
                 if password != "":
                     file.setpassword(password.encode())
-                for number in numbers:
-                    if number.image is not None:
-                        file.writestr((str(number.number) + ".png"), number.image)
+
+                def write_chunk(chunk) -> int:
+                    written = 0
+                    for number, image_hash in chunk:
+                        if not photo_store.exists(image_hash):
+                            self.logger.warning(f"Нет файла фотографии номера {number}")
+                            continue
+                        with photo_store.open(image_hash) as image:
+                            file.writestr(f"{number}.{image_extension(image)}", image)
+                        written += 1
+                    return written
+
+                async for chunk in iter_handled_images(
+                    session, settings.zmq.export_chunk_size, offline=True
+                ):
+                    progress["exported"] += await asyncio.to_thread(write_chunk, chunk)
+                    self.logger.info(
+                        f"Выгружено {progress['exported']} из {progress['total']} фотографий"
+                    )
+        return progress
+
+    def metrics(self) -> dict:
+        """
+        Метрики слушателя вместе с последним снимком основного процесса (settings.metrics.snapshot_file)
+            snapshot_age - сколько секунд назад снимок записан, None - если его ещё нет
+        """
+        snapshot = metrics.read_snapshot(Path(settings.metrics.snapshot_file))
+        merged = metrics.merge(*([snapshot] if snapshot is not None else []), metrics.registry.snapshot())
+        merged["snapshot_age"] = time.time() - snapshot["updated"] if snapshot is not None else None
+        return merged
+
+    def start_job(self, command: str, coroutine: Callable[[dict], Awaitable[dict]]) -> Job:
+        job = Job(command)
+        job.task = asyncio.create_task(job.run(coroutine))
+        self.jobs[job.id] = job
+        # Держим только последние задания, иначе словарь растёт всё время жизни процесса
+        finished = [job_id for job_id, known in self.jobs.items() if known.state != RUNNING]
+        for job_id in finished[: max(len(self.jobs) - settings.zmq.jobs_history, 0)]:
+            del self.jobs[job_id]
+        return job
+
+    async def handle(self, message: Any) -> dict:
+        match message:
+            case {"command": "upload", "data": list(numbers)}:
+                return {"command": UPLOAD, "status": OK, "data": await self.upload(numbers)}
+            case {"command": "download", "data": {"filename": filename, "password": password}}:
+                job = self.start_job(
+                    DOWNLOAD, lambda progress: self.download(filename, password, progress)
+                )
+                self.logger.info(f"Запущена выгрузка в {filename}, задание {job.id}")
+                return {"command": DOWNLOAD, "status": OK, "data": job.info()}
+            case {"command": "job", "data": {"id": str(job_id)}}:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return {"command": JOB, "status": ERR, "data": {"id": job_id}}
+                return {"command": JOB, "status": OK, "data": job.info()}
+            case {"command": "metrics"}:
+                return {"command": METRICS, "status": OK, "data": self.metrics()}
+            case {"command": "status"}:
+                # Статус исторически отдаётся без обёртки
+                return (await self.status()).dict()
+        self.logger.warning("Не удалось распознать схему запроса")
+        return {"status": ERR}
+
+    async def serve(self, socket: zmq.asyncio.Socket, envelope: list[bytes], payload: bytes):
+        command = None
+        try:
+            message = msgpack.unpackb(payload)
+            command = message.get("command") if isinstance(message, dict) else None
+            # Целиком не логируем: в upload прилетают тысячи номеров
+            self.logger.debug(f"Получил сообщение: {command}")
+            label = command if command in COMMANDS else UNKNOWN
+            with metrics.registry.timer(COMMAND_SECONDS, command=label):
+                response = await self.handle(message)
+        except Exception as e:
+            self.logger.error(e)
+            response = {"status": ERR, "command": command}
+        await socket.send_multipart(envelope + [msgpack.packb(response)])
 
     async def start_listening(self):
-        context = zmq.Context()
-        socket = context.socket(zmq.REP)
-        with socket.bind(
-            f"tcp://127.0.0.1:{self.port}"
-        ):
+        context = zmq.asyncio.Context()
+        socket = context.socket(zmq.ROUTER)
+        with socket.bind(f"tcp://127.0.0.1:{self.port}"):
             self.logger.info(f"Начинаю слушать tcp://127.0.0.1:{self.port}")
-            message = {}
+            requests: set[asyncio.Task] = set()
             while True:
-                try:
-                    message = msgpack.unpackb(socket.recv())
-                    self.logger.debug(f"Получил сообщение: {message}")
-                    match message:
-                        case {"command": command, "data": data}:
-                            self.logger.debug("Сообщение с аргументами")
-                            if command == UPLOAD:
-                                await self.upload(data)
-                                socket.send(
-                                    msgpack.packb({"command": UPLOAD, "status": OK})
-                                )
-                                self.logger.debug("Загрузил номера")
-                            elif command == DOWNLOAD:
-                                await self.download(data["filename"], data["password"])
-                                socket.send(
-                                    msgpack.packb({"command": DOWNLOAD, "status": OK})
-                                )
-                                self.logger.debug(f"Выгрузил номера в {data['filename']}")
-                        case {"command": command}:
-                            self.logger.debug("Сообщение без аргументов")
-                            if command == STATUS:
-                                self.logger.debug("Статус")
-                                socket.send(msgpack.packb((await self.status()).dict()))
-                                self.logger.debug("Отправил статус")
-
-                        case _:
-                            self.logger.warning("Не удалось распознать схему запроса")
-                            socket.send(msgpack.packb({"status": ERR}))
-                except Exception as e:
-                    socket.send(msgpack.packb({"status": ERR, "command": message}))
-                    self.logger.error(e)
+                # [identity, b"", payload] от REQ или DEALER с пустым разделителем - конверт возвращаем как есть
+                *envelope, payload = await socket.recv_multipart()
+                request = asyncio.create_task(self.serve(socket, envelope, payload))
+                requests.add(request)
+                request.add_done_callback(requests.discard)
 
     @staticmethod
     def start():
+        # Процесс слушателя получен через fork и унаследовал счётчики основного процесса, а они
+        # и так приходят в metrics() из снимка - без сброса они считались бы дважды
+        metrics.registry.reset()
         listener = ZmqListenerService()
         asyncio.run(listener.start_listening())
@@ -1,19 +1,92 @@
-from typing import TypeVar
+import functools
+import lzma
+import zlib
+from typing import TypeVar, Type
 
-from lzma import decompress, compress
 import msgpack
 from nats.aio.msg import Msg
+from pydantic import BaseModel
+
+from config import settings
 
 BaseModelType = TypeVar("BaseModelType", bound="BaseModel")
 
+# Первый байт сообщения - идентификатор кодека. Старые клиенты слали голый LZMA (.xz),
+# он начинается с 0xFD и по-прежнему распознаётся при чтении
+RAW = "msgpack"
+ZLIB = "zlib"
+LZMA = "lzma"
+LEGACY_LZMA = "legacy-lzma"
+
+CODEC_HEADERS = {RAW: 0x01, ZLIB: 0x02, LZMA: 0x03}
+CODECS_BY_HEADER = {header: codec for codec, header in CODEC_HEADERS.items()}
+XZ_MAGIC = b"\xfd7zXZ\x00"
+
+
+def encode(payload: bytes, codec: str, threshold: int) -> bytes:
+    if codec == LEGACY_LZMA:
+        return lzma.compress(payload)
+    # Маленькие сообщения (пинги, init) сжатие только раздувает
+    if len(payload) < threshold:
+        codec = RAW
+
+    if codec == ZLIB:
+        payload = zlib.compress(payload, 1)
+    elif codec == LZMA:
+        payload = lzma.compress(payload)
+    elif codec != RAW:
+        raise ValueError(f"Неизвестный кодек: {codec}")
+    return bytes((CODEC_HEADERS[codec],)) + payload
+
+
+def decode(data: bytes) -> bytes | memoryview:
+    if data[:6] == XZ_MAGIC:
+        return lzma.decompress(data)
+
+    codec = CODECS_BY_HEADER.get(data[0])
+    body = memoryview(data)[1:]
+    if codec == RAW:
+        return body
+    if codec == ZLIB:
+        return zlib.decompress(body)
+    if codec == LZMA:
+        return lzma.decompress(body)
+    raise ValueError(f"Неизвестный заголовок кодека: {data[0]}")
+
 
-def unpack_msg(msg: Msg, message_type: BaseModelType) -> BaseModelType | None:
+def unpack_msg(msg: Msg, message_type: Type[BaseModelType]) -> BaseModelType | None:
     try:
-        data = msgpack.unpackb(decompress(msg.data))
-        return message_type.parse_obj(data)
+        return message_type.parse_obj(msgpack.unpackb(decode(msg.data)))
     except Exception:
         return None
 
 
-def pack_msg(msg: BaseModelType) -> bytes:
-    return compress(msgpack.packb(msg.dict()))
+# Кодек, о котором договорились с сервером при аутентификации (см. negotiate_codec), None - settings.codec.name
+negotiated_codec: str | None = None
+
+
+@functools.cache
+def codec_settings() -> tuple[str, int]:
+    # Обращение к dynaconf на каждое сообщение стоит дороже самого msgpack, читаем настройки один раз
+    return settings.codec.name, settings.codec.threshold
+
+
+def supported_codecs() -> list[str]:
+    return [ZLIB, LZMA, RAW]
+
+
+def negotiate_codec(server_codecs: list[str] | None) -> str:
+    """
+    Выбирает кодек исходящих сообщений по списку, который сервер прислал в ответ на init
+        Сервер, который ничего не объявил, понимает только голый LZMA, поэтому кодек с заголовком
+        включается лишь тогда, когда settings.codec.preferred есть в списке сервера
+    """
+    global negotiated_codec
+    preferred = settings.codec.preferred
+    negotiated_codec = preferred if server_codecs and preferred in server_codecs else None
+    return negotiated_codec or codec_settings()[0]
+
+
+def pack_msg(msg: BaseModel, codec: str | None = None) -> bytes:
+    default_codec, threshold = codec_settings()
+    return encode(msgpack.packb(msg.dict()), codec or negotiated_codec or default_codec, threshold)